@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import typing
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from const import *
+
+# 不需要重放的请求头, 由 requests 自己生成
+_SKIPPED_HEADERS = {"content-length", "cookie", "host", "connection", "accept-encoding"}
+
+
+class ApiError(Exception):
+    """the 95598 JSON endpoint is missing, failed or returned unexpected data"""
+
+
+class CapturedRequest(typing.NamedTuple):
+    method: str
+    url: str
+    headers: typing.Dict[str, str]
+    body: typing.Optional[str]
+
+
+def load_endpoints() -> dict:
+    endpoints = API_ENDPOINTS
+    if os.getenv("SGCC_API_ENDPOINTS"):
+        endpoints = {**endpoints, **json.loads(os.getenv("SGCC_API_ENDPOINTS"))}
+    return endpoints
+
+
+def capture_api_requests(
+    driver: WebDriver, endpoints: dict
+) -> typing.Dict[str, CapturedRequest]:
+    """
+    Pick the XHR calls of the 95598 SPA out of the chrome performance log.
+
+    The driver must be created with the ``goog:loggingPrefs`` performance
+    capability, every call to this function drains the log buffer.
+
+    :return: captured requests keyed by endpoint path, the latest call wins.
+    """
+    paths = {spec["path"] for spec in endpoints.values()}
+    captured = {}
+    for entry in driver.get_log("performance"):
+        try:
+            message = json.loads(entry["message"])["message"]
+        except (KeyError, ValueError):
+            continue
+        if message.get("method") != "Network.requestWillBeSent":
+            continue
+        request = message["params"]["request"]
+        path = urlsplit(request["url"]).path
+        if path not in paths:
+            continue
+        captured[path] = CapturedRequest(
+            request["method"],
+            request["url"],
+            {
+                k: v
+                for k, v in request.get("headers", {}).items()
+                if k.lower() not in _SKIPPED_HEADERS and not k.startswith(":")
+            },
+            request.get("postData"),
+        )
+        logging.debug("Captured 95598 api request %s %s", request["method"], path)
+    return captured
+
+
+def _lookup(data, dotted_path: str):
+    for key in dotted_path.split("."):
+        if isinstance(data, list):
+            data = data[int(key)]
+        else:
+            data = data[key]
+    return data
+
+
+class ApiFetcher:
+    """
+    Replay the captured 95598 XHR calls with a pooled requests.Session, so the
+    browser is only needed for authentication.
+    """
+
+    def __init__(
+        self,
+        captured: typing.Dict[str, CapturedRequest],
+        captured_user_id: str,
+        cookies: typing.List[dict],
+        endpoints: dict = None,
+        base_url: str = None,
+        timeout: int = 10,
+    ):
+        self._captured = captured
+        self._captured_user_id = captured_user_id
+        self._endpoints = endpoints or load_endpoints()
+        self._base_url = base_url or os.getenv("SGCC_API_BASE_URL")
+        self._timeout = timeout
+        self._responses = {}
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=8)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        for cookie in cookies:
+            self._session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie.get("domain"),
+                path=cookie.get("path", "/"),
+            )
+
+    @classmethod
+    def from_driver(
+        cls, driver: WebDriver, user_id_list: typing.List[str], **kwargs
+    ) -> "ApiFetcher":
+        endpoints = kwargs.pop("endpoints", None) or load_endpoints()
+        captured = capture_api_requests(driver, endpoints)
+        if not captured:
+            raise ApiError("no 95598 api request captured")
+        # 找出网页请求时使用的用户号, 重放时替换为其他用户号
+        captured_user_id = next(
+            (
+                user_id
+                for user_id in user_id_list
+                for request in captured.values()
+                if user_id in request.url or user_id in (request.body or "")
+            ),
+            None,
+        )
+        return cls(
+            captured,
+            captured_user_id,
+            driver.get_cookies(),
+            endpoints=endpoints,
+            **kwargs,
+        )
+
+    def close(self):
+        self._session.close()
+
+    def _request(self, kind: str, user_id: str):
+        spec = self._endpoints.get(kind)
+        if not spec or spec["path"] not in self._captured:
+            raise ApiError(f"api endpoint for {kind} was not captured")
+        cache_key = (spec["path"], user_id)
+        if cache_key in self._responses:
+            return self._responses[cache_key]
+
+        request = self._captured[spec["path"]]
+        url, body = request.url, request.body
+        if user_id != self._captured_user_id:
+            # 不能替换用户号时重放会拿到别的户号的数据
+            if not self._captured_user_id or not (
+                self._captured_user_id in url
+                or self._captured_user_id in (body or "")
+            ):
+                raise ApiError(f"captured {kind} request has no user id to replace")
+            url = url.replace(self._captured_user_id, user_id)
+            body = body.replace(self._captured_user_id, user_id) if body else body
+        if self._base_url:
+            base = urlsplit(self._base_url)
+            url = urlunsplit((base.scheme, base.netloc) + tuple(urlsplit(url))[2:])
+
+        try:
+            response = self._session.request(
+                request.method,
+                url,
+                headers=request.headers,
+                data=body.encode("utf-8") if body else None,
+                timeout=self._timeout,
+            )
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise ApiError(f"request {kind} api failed: {e}") from e
+        self._responses[cache_key] = data
+        return data
+
+    def _field(self, kind: str, data, name: str, default=ApiError):
+        for dotted_path in self._endpoints[kind]["fields"].get(name, []):
+            try:
+                return _lookup(data, dotted_path)
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+        if default is ApiError:
+            raise ApiError(f"field {name} not found in {kind} api response")
+        return default
+
+    def get_balance(self, user_id: str) -> float:
+        data = self._request("balance", user_id)
+        try:
+            balance = float(self._field("balance", data, "balance"))
+            arrears = float(self._field("balance", data, "arrears", 0) or 0)
+        except (TypeError, ValueError) as e:
+            raise ApiError(f"unexpected balance value: {e}") from e
+        return -arrears if arrears > 0 and balance == 0 else balance
+
+    def get_yearly_data(self, user_id: str) -> typing.Tuple[float, float]:
+        data = self._request("yearly", user_id)
+        try:
+            return (
+                float(self._field("yearly", data, "usage")),
+                float(self._field("yearly", data, "charge")),
+            )
+        except (TypeError, ValueError) as e:
+            raise ApiError(f"unexpected yearly value: {e}") from e
+
+    def get_month_usage(self, user_id: str):
+        data = self._request("monthly", user_id)
+        month, usage, charge = [], [], []
+        for row in self._field("monthly", data, "rows"):
+            month.append(self._field("monthly", row, "month"))
+            usage.append(self._field("monthly", row, "usage"))
+            charge.append(self._field("monthly", row, "charge"))
+        return month, usage, charge
+
+    def get_daily_usage_data(
+        self, user_id: str, retention_days: int = 7
+    ) -> typing.List[typing.Tuple[str, float]]:
+        data = self._request("daily", user_id)
+        rows = self._field("daily", data, "rows")
+        if len(rows) < retention_days:
+            # 网页接口默认只返回最近 7 天
+            raise ApiError(
+                f"daily api returned {len(rows)} days, {retention_days} days wanted"
+            )
+        days = []
+        for row in rows:
+            usage = self._field("daily", row, "usage", "")
+            if usage in ("", None, "-"):
+                continue
+            try:
+                days.append((str(self._field("daily", row, "day")), float(usage)))
+            except (TypeError, ValueError) as e:
+                raise ApiError(f"unexpected daily value: {e}") from e
+        # 与网页表格一致, 最近一天在最前面
+        days.sort(key=lambda x: x[0], reverse=True)
+        return days[:retention_days]
+
+    def get_all_data(self, user_id: str):
+        """same return value as DataFetcher._get_all_data"""
+        balance = self.get_balance(user_id)
+        yearly_usage, yearly_charge = self.get_yearly_data(user_id)
+        _, month_usage, month_charge = self.get_month_usage(user_id)
+        retention_days = os.getenv("DATA_RETENTION_DAYS", "7")
+        retention_days = int(retention_days) if retention_days.isdigit() else 7
+        days = self.get_daily_usage_data(user_id, retention_days)
+        if not days:
+            raise ApiError("daily api response has no usage")
+        last_daily_date, last_daily_usage = days[0]
+
+        try:
+            month_charge = float(month_charge[-1]) if month_charge else None
+            month_usage = float(month_usage[-1]) if month_usage else None
+        except (TypeError, ValueError) as e:
+            raise ApiError(f"unexpected monthly value: {e}") from e
+
+        return (
+            balance,
+            last_daily_date,
+            last_daily_usage,
+            yearly_charge,
+            yearly_usage,
+            month_charge,
+            month_usage,
+            days if os.getenv("DATA_RETENTION_DAYS") else None,
+        )
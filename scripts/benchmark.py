@@ -0,0 +1,795 @@
+"""
+Offline benchmarks, run from the scripts directory:
+
+    python benchmark.py replay <recorded pages> [--runs 3]
+    python benchmark.py boxes <captcha images or .npy predictions> [--threshold 0.7]
+    python benchmark.py session <captcha image> [--repeat 50]
+    python benchmark.py preprocess <captcha image> [--repeat 200]
+    python benchmark.py capture <recorded pages> [--repeat 20]
+    python benchmark.py captcha <labelled images> [--tolerance 5] [--baseline captcha_baseline.json]
+    python benchmark.py mqtt [--messages 500] [--latency-ms 2]
+    python benchmark.py topics [--users 4] [--repeat 2000]
+"""
+
+import argparse
+import json
+import logging
+import os
+import socketserver
+import statistics
+import sys
+import threading
+import time
+import typing
+
+
+def _load_env():
+    if "PYTHON_IN_DOCKER" not in os.environ:
+        try:
+            import dotenv
+
+            dotenv.load_dotenv()
+        except ImportError:
+            pass
+
+
+def _print_table(header: typing.List[str], rows: typing.List[list]):
+    widths = [
+        max(len(str(cell)) for cell in column) for column in zip(header, *rows)
+    ]
+    for row in [header] + rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+def bench_replay(args):
+    """DataFetcher.fetch() end to end against the recorded portal and a stand-in broker"""
+    from portal_replay import ReplayServer
+
+    server = ReplayServer(args.path).start()
+    broker = StandInBroker(args.latency_ms / 1000)
+    # const 在导入时读取 SGCC_PORTAL_URL, 所以先启动回放服务再导入
+    os.environ["SGCC_PORTAL_URL"] = server.url
+    os.environ["ENABLE_SESSION_STORE"] = "false"
+    os.environ["ENABLE_CHECKPOINT"] = "false"
+    # 不连接真实的 broker; 每次运行都发布全部消息, 结果可以互相比较
+    os.environ["MQTT_HOST"] = "127.0.0.1"
+    os.environ["MQTT_PORT"] = str(broker.port)
+    os.environ["MQTT_USERNAME"] = ""
+    os.environ["MQTT_PASSWORD"] = ""
+    os.environ["MQTT_PUBLISH_CACHE"] = "false"
+    from data_fetcher import DataFetcher
+    from metrics import METRICS
+
+    # 单独的 client id, 队列和自动发现记录不和正式运行的混在一起
+    data_fetcher = DataFetcher(
+        os.getenv("PHONE_NUMBER") or "replay",
+        os.getenv("PASSWORD") or "replay",
+        mqtt_client_id="sgcc_replay",
+    )
+    summaries = []
+    try:
+        for run in range(1, args.runs + 1):
+            METRICS.start_run()
+            try:
+                with data_fetcher:
+                    with METRICS.timer("fetch"):
+                        data_fetcher.fetch()
+            except Exception as e:
+                logging.error("Replay run %d failed: %s", run, e)
+                continue
+            summaries.append(METRICS.run_summary())
+    finally:
+        data_fetcher.close()
+        server.stop()
+        broker.shutdown()
+
+    if not summaries:
+        print("all replay runs failed")
+        return 1
+    phases = sorted({phase for summary in summaries for phase in summary["phases"]})
+    rows = []
+    for phase in phases:
+        totals = [s["phases"][phase]["total"] for s in summaries if phase in s["phases"]]
+        rows.append(
+            [
+                phase,
+                len(totals),
+                "%.3f" % statistics.mean(totals),
+                "%.3f" % min(totals),
+                "%.3f" % max(totals),
+            ]
+        )
+    rows.sort(key=lambda row: float(row[2]), reverse=True)
+    print(
+        f"{len(summaries)}/{args.runs} runs against {args.path}, "
+        f"{broker.received} MQTT messages, seconds per run:"
+    )
+    _print_table(["phase", "runs", "mean", "min", "max"], rows)
+    return 0
+
+
+def _timeit(func, repeat: int) -> typing.List[float]:
+    """milliseconds of each call"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def _legacy_nms(dets, thresh):
+    """ONNX.nms before vectorization, for comparison"""
+    import numpy as np
+
+    x1, y1, x2, y2, scores = dets[:, 0], dets[:, 1], dets[:, 2], dets[:, 3], dets[:, 4]
+    areas = (y2 - y1 + 1) * (x2 - x1 + 1)
+    keep = []
+    index = scores.argsort()[::-1]
+    while index.size > 0:
+        i = index[0]
+        keep.append(i)
+        x11 = np.maximum(x1[i], x1[index[1:]])
+        y11 = np.maximum(y1[i], y1[index[1:]])
+        x22 = np.minimum(x2[i], x2[index[1:]])
+        y22 = np.minimum(y2[i], y2[index[1:]])
+        w = np.maximum(0, x22 - x11 + 1)
+        h = np.maximum(0, y22 - y11 + 1)
+        overlaps = w * h
+        ious = overlaps / (areas[i] + areas[index[1:]] - overlaps)
+        index = index[np.where(ious <= thresh)[0] + 1]
+    return keep
+
+
+def _legacy_get_boxes(model, prediction, confidence_threshold=0.7, nms_threshold=0.6):
+    """ONNX.get_boxes before vectorization, for comparison"""
+    import numpy as np
+
+    feature_map = np.squeeze(prediction)
+    box = feature_map[feature_map[..., 4] > confidence_threshold]
+    cls = [int(np.argmax(scores)) for scores in box[..., 5:]]
+    output = []
+    for curr_cls in set(cls):
+        curr_cls_box = []
+        for j in range(len(cls)):
+            if cls[j] == curr_cls:
+                box[j][5] = curr_cls
+                curr_cls_box.append(box[j][:6])
+        curr_cls_box = model.xywh2xyxy(np.array(curr_cls_box))
+        for k in _legacy_nms(curr_cls_box, nms_threshold):
+            output.append(curr_cls_box[k])
+    return np.array(output)
+
+
+def _load_predictions(model, paths: typing.List[str]):
+    import numpy as np
+    from PIL import Image
+
+    predictions = []
+    for path in paths:
+        if path.endswith(".npy"):
+            predictions.append(np.load(path))
+        else:
+            prediction = model._inference(Image.open(path))[0]
+            predictions.append(prediction)
+    return predictions
+
+
+def bench_boxes(args):
+    """vectorized ONNX.get_boxes against the previous loop implementation"""
+    import numpy as np
+    from onnx import ONNX
+
+    model = ONNX(args.model)
+    predictions = _load_predictions(model, args.paths)
+    if args.save:
+        for path, prediction in zip(args.paths, predictions):
+            if not path.endswith(".npy"):
+                np.save(os.path.splitext(path)[0] + ".npy", prediction)
+
+    rows = []
+    for path, prediction in zip(args.paths, predictions):
+        old = _legacy_get_boxes(model, prediction.copy(), args.threshold)
+        old = old[np.argsort(-old[:, 4], kind="stable")] if len(old) else old
+        new = model.get_boxes(prediction.copy(), args.threshold, top_k=args.top_k)
+        scores = np.sort(np.squeeze(prediction)[..., 4].ravel())[::-1]
+        scores = scores[scores > args.threshold]
+        if args.top_k is not None and len(scores) > args.top_k and len(old):
+            # 限制 top_k 时只和原来结果里分数在前 top_k 个候选框之内的框比较
+            old = old[old[:, 4] >= scores[args.top_k - 1] - 1e-6]
+        same = len(old) == len(new) and (
+            len(new) == 0 or np.allclose(old, new, atol=1e-4)
+        )
+        old_ms = _timeit(
+            lambda: _legacy_get_boxes(model, prediction.copy(), args.threshold),
+            args.repeat,
+        )
+        new_ms = _timeit(
+            lambda: model.get_boxes(prediction.copy(), args.threshold, top_k=args.top_k),
+            args.repeat,
+        )
+        rows.append(
+            [
+                os.path.basename(path),
+                int((np.squeeze(prediction)[..., 4] > args.threshold).sum()),
+                len(new),
+                "%.3f" % statistics.median(old_ms),
+                "%.3f" % statistics.median(new_ms),
+                "%.1fx" % (statistics.median(old_ms) / statistics.median(new_ms)),
+                "yes" if same else "NO",
+            ]
+        )
+    print(
+        f"get_boxes median of {args.repeat} calls, confidence threshold {args.threshold}, "
+        f"top_k {args.top_k or 'all'}:"
+    )
+    _print_table(
+        ["input", "candidates", "boxes", "old ms", "new ms", "speedup", "same"], rows
+    )
+    return 0
+
+
+def bench_session(args):
+    """captcha model load time and inference latency, default against tuned session"""
+    import tempfile
+
+    import onnxruntime
+    from PIL import Image
+    from onnx import ONNX
+
+    image = Image.open(args.image)
+    rows = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for label in ("default session", "tuned, cold cache", "tuned, warm cache"):
+            model = ONNX(args.model, cache_dir=cache_dir)
+            start = time.perf_counter()
+            if label == "default session":
+                model._session = onnxruntime.InferenceSession(args.model)
+            else:
+                model.onnx_session
+            load_ms = (time.perf_counter() - start) * 1000
+            model._inference(image)  # warm up
+            latencies = sorted(_timeit(lambda: model._inference(image), args.repeat))
+            rows.append(
+                [
+                    label,
+                    "%.1f" % load_ms,
+                    "%.2f" % statistics.median(latencies),
+                    "%.2f" % latencies[int(len(latencies) * 0.95) - 1],
+                ]
+            )
+    print(f"{args.model}, {args.repeat} inferences of {args.image}:")
+    _print_table(["session", "load ms", "p50 ms", "p95 ms"], rows)
+    return 0
+
+
+def _legacy_preprocess(image):
+    """ONNX._inference preprocessing before the reused input buffer, for comparison"""
+    import numpy as np
+
+    img = image.resize((416, 416)).convert("RGB")
+    img = np.array(img).transpose(2, 0, 1)
+    img = img.astype(dtype=np.float32)
+    img /= 255.0
+    return np.expand_dims(img, axis=0)
+
+
+def _peak_memory_kb(func) -> float:
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def bench_preprocess(args):
+    """captcha preprocessing latency and peak allocation, old path against the reused buffer"""
+    import numpy as np
+    from PIL import Image
+    from onnx import ONNX
+
+    image = Image.open(args.image)
+    image.load()
+    model = ONNX(cache_dir="")
+    stretched = lambda: model._preprocess(image)
+    letterboxed = ONNX(cache_dir="")
+    letterboxed.use_letterbox = True
+
+    same = np.allclose(_legacy_preprocess(image), stretched()[0])
+    rows = []
+    for label, func in (
+        ("old", lambda: _legacy_preprocess(image)),
+        ("buffer", stretched),
+        ("buffer + letterbox", lambda: letterboxed._preprocess(image)),
+    ):
+        func()
+        latencies = _timeit(func, args.repeat)
+        rows.append(
+            [
+                label,
+                "%.3f" % statistics.median(latencies),
+                "%.0f" % _peak_memory_kb(func),
+            ]
+        )
+    print(f"preprocess {image.size} {args.image}, same input as old path: {same}")
+    _print_table(["path", "p50 ms", "peak KB"], rows)
+    return 0
+
+
+def _replay_driver(server):
+    """a headless chrome on the replayed login page with the slider captcha"""
+    from selenium.webdriver import Chrome, ChromeService
+    from selenium.webdriver.chrome.options import Options
+
+    options = Options()
+    for argument in ("--headless", "--no-sandbox", "--disable-gpu", "--window-size=1920,1080"):
+        options.add_argument(argument)
+    driver = Chrome(
+        service=ChromeService(executable_path="/usr/bin/chromedriver"), options=options
+    )
+    driver.get(server.url + "/osgweb/login")
+    return driver
+
+
+def bench_capture(args):
+    """slider captcha capture, canvas pixels against element screenshot"""
+    import base64
+
+    from PIL import Image
+    from io import BytesIO
+    from selenium.webdriver.common.by import By
+
+    import dom_extract
+    from portal_replay import ReplayServer
+
+    with ReplayServer(args.path) as server:
+        driver = _replay_driver(server)
+        try:
+            elem = driver.find_element(By.ID, "slideVerify")
+
+            def screenshot():
+                image = Image.open(BytesIO(base64.b64decode(elem.screenshot_as_base64)))
+                image.load()
+                return image
+
+            canvas = lambda: dom_extract.canvas_pixels(driver, elem)
+            pixels, image = canvas(), screenshot()
+            rows = []
+            for label, func in (("screenshot", screenshot), ("canvas", canvas)):
+                latencies = _timeit(func, args.repeat)
+                rows.append([label, "%.1f" % statistics.median(latencies)])
+        finally:
+            driver.quit()
+    print(
+        f"captcha capture, {args.repeat} runs, screenshot {image.size}, canvas "
+        f"{None if pixels is None else pixels.shape[1::-1]}:"
+    )
+    _print_table(["capture", "p50 ms"], rows)
+    return 0
+
+
+def _percentile(values: typing.List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[max(0, int(round(len(values) * percent / 100)) - 1)]
+
+
+def bench_captcha(args):
+    """
+    captcha solver accuracy and latency over labelled images, fails on regression.
+    The directory holds the images and labels.json of {"file name": slide distance in
+    pixels that passed}, a run with CAPTCHA_CORPUS_DIR set collects them. Those
+    labels are the model's own distances that passed, so the accuracy on them is
+    partly circular; hand-labelled images are needed for an absolute number.
+    """
+    from PIL import Image
+    from onnx import ONNX
+
+    with open(os.path.join(args.path, "labels.json"), encoding="utf-8") as f:
+        labels = json.load(f)
+    model = ONNX(args.model)
+    if args.letterbox:
+        model.use_letterbox = True
+    model.onnx_session  # 不把模型加载算进第一张图的耗时
+
+    results = []
+    for name, truth in sorted(labels.items()):
+        image = Image.open(os.path.join(args.path, name))
+        image.load()
+        start = time.perf_counter()
+        candidates = model.get_candidates(image)
+        latency = (time.perf_counter() - start) * 1000
+        compensation = model.slide_compensation(image)
+        results.append(
+            (name, truth, [x for x, _ in candidates], latency, compensation)
+        )
+    if not results:
+        print(f"no labelled image in {args.path}")
+        return 1
+
+    def accuracy(factor: float = None, top: int = 1) -> float:
+        """factor None is the compensation the login uses for each image"""
+        hits = sum(
+            any(
+                abs(x * (compensation if factor is None else factor) - truth)
+                <= args.tolerance
+                for x in xs[:top]
+            )
+            for _, truth, xs, _, compensation in results
+        )
+        return hits / len(results)
+
+    detected = [(xs[0], truth) for _, truth, xs, *_ in results if xs]
+    # 让预测距离和真实距离误差平方和最小的系数
+    best_factor = (
+        sum(x * truth for x, truth in detected) / sum(x * x for x, _ in detected)
+        if detected and any(x for x, _ in detected)
+        else 1.0
+    )
+    latencies = [latency for _, _, _, latency, _ in results]
+    compensation = statistics.mean(c for *_, c in results)
+    report = {
+        "images": len(results),
+        "tolerance": args.tolerance,
+        "letterbox": model.use_letterbox,
+        "compensation": round(compensation, 4),
+        "accuracy": accuracy(),
+        "accuracy_top3": accuracy(top=3),
+        "accuracy_uncompensated": accuracy(1.0),
+        "best_factor": round(best_factor, 4),
+        "accuracy_best_factor": accuracy(best_factor),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(_percentile(latencies, 95), 2),
+        "throughput": round(len(results) / (sum(latencies) / 1000), 1),
+    }
+
+    if args.verbose:
+        _print_table(
+            ["image", "truth", "candidates", "ms"],
+            [[name, truth, xs, "%.1f" % ms] for name, truth, xs, ms, _ in results],
+        )
+    print(f"{report['images']} images, accuracy within +-{args.tolerance}px:")
+    print(
+        "note: labels collected with CAPTCHA_CORPUS_DIR are the model's own "
+        "distances that passed, so the accuracy is partly circular: the model "
+        "that collected them scores near 100%. Use it to catch regressions "
+        "against that model, not as the accuracy on new captchas."
+    )
+    _print_table(
+        ["factor", "top-1", "top-3"],
+        [
+            [
+                report["compensation"],
+                "%.1f%%" % (report["accuracy"] * 100),
+                "%.1f%%" % (report["accuracy_top3"] * 100),
+            ],
+            [1.0, "%.1f%%" % (report["accuracy_uncompensated"] * 100), ""],
+            [report["best_factor"], "%.1f%%" % (report["accuracy_best_factor"] * 100), ""],
+        ],
+    )
+    print(
+        "latency p50 %.1f ms, p95 %.1f ms, %.1f images/s"
+        % (report["p50_ms"], report["p95_ms"], report["throughput"])
+    )
+
+    failures = []
+    if report["accuracy"] < args.min_accuracy:
+        failures.append(f"accuracy {report['accuracy']:.3f} < {args.min_accuracy}")
+    if args.max_p95_ms and report["p95_ms"] > args.max_p95_ms:
+        failures.append(f"p95 {report['p95_ms']} ms > {args.max_p95_ms} ms")
+    if args.baseline and os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if report["accuracy"] < baseline["accuracy"] - args.accuracy_drop:
+            failures.append(
+                f"accuracy {report['accuracy']:.3f} dropped from baseline {baseline['accuracy']:.3f}"
+            )
+        if report["p95_ms"] > baseline["p95_ms"] * (1 + args.latency_increase):
+            failures.append(
+                f"p95 {report['p95_ms']} ms is slower than baseline {baseline['p95_ms']} ms"
+            )
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    return 1 if failures else 0
+
+
+class StandInBroker(socketserver.ThreadingTCPServer):
+    """
+    Just enough MQTT 3.1.1 to accept publishes: CONNACK, PUBACK for QoS 1,
+    PINGRESP. Replies are sent latency seconds after the packet arrived, like
+    a broker across the network, without holding up the following packets.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.received = 0
+        super().__init__(("127.0.0.1", 0), self._Handler)
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    class _Handler(socketserver.BaseRequestHandler):
+        def _read(self, size: int) -> bytes:
+            data = b""
+            while len(data) < size:
+                chunk = self.request.recv(size - len(data))
+                if not chunk:
+                    raise ConnectionError
+                data += chunk
+            return data
+
+        def _send_later(self, replies: "queue.Queue"):
+            while True:
+                due, data = replies.get()
+                if data is None:
+                    return
+                time.sleep(max(0.0, due - time.monotonic()))
+                try:
+                    self.request.sendall(data)
+                except OSError:
+                    return
+
+        def handle(self):
+            import queue
+
+            server = self.server
+            replies = queue.Queue()
+            threading.Thread(target=self._send_later, args=(replies,), daemon=True).start()
+            reply = lambda data: replies.put((time.monotonic() + server.latency, data))
+            try:
+                while True:
+                    header = self._read(1)[0]
+                    length, shift = 0, 0
+                    while True:
+                        byte = self._read(1)[0]
+                        length += (byte & 0x7F) << shift
+                        shift += 7
+                        if not byte & 0x80:
+                            break
+                    body = self._read(length)
+                    packet_type, qos = header >> 4, (header >> 1) & 0x03
+                    if packet_type == 1:  # CONNECT
+                        reply(b"\x20\x02\x00\x00")
+                    elif packet_type == 3:  # PUBLISH
+                        server.received += 1
+                        if qos:
+                            topic_length = int.from_bytes(body[:2], "big")
+                            packet_id = body[2 + topic_length : 4 + topic_length]
+                            reply(b"\x40\x02" + packet_id)
+                    elif packet_type == 12:  # PINGREQ
+                        reply(b"\xd0\x00")
+                    elif packet_type == 14:  # DISCONNECT
+                        return
+            except (ConnectionError, OSError):
+                return
+            finally:
+                replies.put((0, None))
+
+
+def _legacy_publish(port: int, messages: int, qos: int):
+    """connect, publish and wait_for_publish one by one, disconnect: the updator before pipelining"""
+    from paho.mqtt.client import Client
+
+    client = Client(client_id="sgcc_bench_legacy")
+    client.connect("127.0.0.1", port)
+    # QoS 1 的 PUBACK 需要网络线程读取
+    client.loop_start()
+    for i in range(messages):
+        client.publish(f"bench/{i % 10}", str(i), qos=qos).wait_for_publish()
+    client.disconnect()
+    client.loop_stop()
+
+
+def _pipelined_publish(port: int, messages: int, qos: int, max_inflight: int):
+    from sensor_updator import MQTTSensorUpdator
+
+    updator = MQTTSensorUpdator(
+        None, None, "127.0.0.1", port, "sgcc_bench", max_inflight=max_inflight, qos=qos
+    )
+    try:
+        with updator:
+            for i in range(messages):
+                updator._publish_message(f"bench/{i % 10}", str(i))
+    finally:
+        updator.close()
+
+
+def bench_mqtt(args):
+    """MQTT publish throughput, one wait per message against the pipelined updator"""
+    import sensor_updator  # 不把导入时间算进第一轮
+
+    broker = StandInBroker(args.latency_ms / 1000)
+    rows = []
+    try:
+        for qos in (0, 1):
+            for label, func in (
+                ("wait per message", lambda: _legacy_publish(broker.port, args.messages, qos)),
+                (
+                    f"pipelined, window {args.max_inflight}",
+                    lambda: _pipelined_publish(
+                        broker.port, args.messages, qos, args.max_inflight
+                    ),
+                ),
+            ):
+                broker.received = 0
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+                time.sleep(0.2)
+                received = broker.received
+                rows.append(
+                    [qos, label, received, "%.0f" % (args.messages / elapsed)]
+                )
+    finally:
+        broker.shutdown()
+    print(
+        f"{args.messages} messages to a stand-in broker answering after {args.latency_ms} ms:"
+    )
+    _print_table(["qos", "publisher", "received", "msg/s"], rows)
+    return 0
+
+
+def bench_topics(args):
+    """topics and discovery configs of a publish, get_message against the topics_for registry"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from const import MQTT_MsgEnum, get_message, topics_for
+
+    user_ids = [str(3000000000 + i) for i in range(args.users)]
+
+    def legacy():
+        for user_id in user_ids:
+            for msg_type in MQTT_MsgEnum:
+                config_topic, config, state_topic, attr_topic = get_message(
+                    msg_type, user_id
+                )
+                json.dumps(config)
+
+    def registry():
+        for user_id in user_ids:
+            for sensor in topics_for(user_id).sensors.values():
+                sensor.config_topic, sensor.config, sensor.state_topic, sensor.attr_topic
+
+    def cold():
+        topics_for.cache_clear()
+        registry()
+
+    same = all(
+        topics_for(user_id).sensors[msg_type].config
+        == json.dumps(get_message(msg_type, user_id)[1]).encode("utf-8")
+        for user_id in user_ids
+        for msg_type in MQTT_MsgEnum
+    )
+    # 并发读取, 每个户号的配置里不能出现别的户号
+    topics_for.cache_clear()
+    with ThreadPoolExecutor(8) as pool:
+        configs = list(pool.map(topics_for, user_ids * 8))
+    isolated = all(
+        user_id.encode() in sensor.config
+        and not any(
+            other.encode() in sensor.config for other in user_ids if other != user_id
+        )
+        for user_id, topics in zip(user_ids * 8, configs)
+        for sensor in topics.sensors.values()
+    )
+
+    rows = []
+    for label, func in (
+        ("get_message", legacy),
+        ("topics_for", registry),
+        ("topics_for cold", cold),
+    ):
+        func()
+        latencies = _timeit(func, args.repeat)
+        rows.append(
+            [
+                label,
+                "%.1f" % (statistics.median(latencies) * 1000),
+                "%.1f" % (_percentile(latencies, 95) * 1000),
+            ]
+        )
+    print(
+        f"{args.users} user ids x {len(MQTT_MsgEnum)} sensors, same configs: {same}, "
+        f"isolated between threads: {isolated}"
+    )
+    _print_table(["path", "p50 us", "p95 us"], rows)
+    return 0
+
+
+def main(argv: typing.List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay = subparsers.add_parser("replay", help=bench_replay.__doc__)
+    replay.add_argument("path", help="pages recorded with SGCC_RECORD_DIR")
+    replay.add_argument("--runs", type=int, default=3)
+    replay.add_argument(
+        "--latency-ms", type=float, default=0, help="stand-in broker reply latency"
+    )
+    replay.set_defaults(func=bench_replay)
+
+    boxes = subparsers.add_parser("boxes", help=bench_boxes.__doc__)
+    boxes.add_argument("paths", nargs="+", help="captcha images or saved predictions")
+    boxes.add_argument("--model", default="captcha.onnx")
+    boxes.add_argument("--threshold", type=float, default=0.7)
+    boxes.add_argument("--repeat", type=int, default=200)
+    boxes.add_argument(
+        "--top-k",
+        type=int,
+        help="keep at most this many candidates before NMS, "
+        "then same compares with the old boxes of the top-k scores",
+    )
+    boxes.add_argument(
+        "--save", action="store_true", help="save the predictions of images as .npy"
+    )
+    boxes.set_defaults(func=bench_boxes)
+
+    session = subparsers.add_parser("session", help=bench_session.__doc__)
+    session.add_argument("image", help="a captcha background image")
+    session.add_argument("--model", default="captcha.onnx")
+    session.add_argument("--repeat", type=int, default=50)
+    session.set_defaults(func=bench_session)
+
+    preprocess = subparsers.add_parser("preprocess", help=bench_preprocess.__doc__)
+    preprocess.add_argument("image", help="a captcha background image")
+    preprocess.add_argument("--repeat", type=int, default=200)
+    preprocess.set_defaults(func=bench_preprocess)
+
+    capture = subparsers.add_parser("capture", help=bench_capture.__doc__)
+    capture.add_argument("path", help="pages recorded with SGCC_RECORD_DIR")
+    capture.add_argument("--repeat", type=int, default=20)
+    capture.set_defaults(func=bench_capture)
+
+    captcha = subparsers.add_parser(
+        "captcha", help=bench_captcha.__doc__.strip().splitlines()[0]
+    )
+    captcha.add_argument("path", help="directory of images and labels.json")
+    captcha.add_argument("--model", default="captcha.onnx")
+    captcha.add_argument("--tolerance", type=int, default=5, help="pixels")
+    captcha.add_argument("--min-accuracy", type=float, default=0.8)
+    captcha.add_argument("--max-p95-ms", type=float, default=0, help="0 to skip")
+    captcha.add_argument("--baseline", help="json report to compare against")
+    captcha.add_argument(
+        "--save-baseline", action="store_true", help="write the report to --baseline"
+    )
+    captcha.add_argument("--accuracy-drop", type=float, default=0.02)
+    captcha.add_argument("--latency-increase", type=float, default=0.2)
+    captcha.add_argument(
+        "--letterbox",
+        action="store_true",
+        help="letterbox preprocessing, tune ONNX_LETTERBOX_COMPENSATION with its best factor",
+    )
+    captcha.add_argument("-v", "--verbose", action="store_true")
+    captcha.set_defaults(func=bench_captcha)
+
+    mqtt = subparsers.add_parser("mqtt", help=bench_mqtt.__doc__)
+    mqtt.add_argument("--messages", type=int, default=500)
+    mqtt.add_argument("--latency-ms", type=float, default=2)
+    mqtt.add_argument("--max-inflight", type=int, default=20)
+    mqtt.set_defaults(func=bench_mqtt)
+
+    topics = subparsers.add_parser("topics", help=bench_topics.__doc__)
+    topics.add_argument("--users", type=int, default=4)
+    topics.add_argument("--repeat", type=int, default=2000)
+    topics.set_defaults(func=bench_topics)
+
+    args = parser.parse_args(argv)
+    _load_env()
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "WARNING"),
+        format="%(asctime)s [%(levelname)s] ---- %(message)s",
+    )
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
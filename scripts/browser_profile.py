@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from const import *
+
+# chrome 缓存目录, 删除后下次启动会重新下载
+_CACHE_DIRS = ["Default/Cache", "Default/Code Cache", "Default/GPUCache"]
+# chrome 异常退出后残留的锁文件, 会导致无法再次打开同一个 profile
+_LOCK_FILES = ["SingletonLock", "SingletonSocket", "SingletonCookie"]
+
+
+def _dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class BrowserProfile:
+    """
+    A persistent chrome --user-data-dir for one account, so the 95598 SPA
+    bundle and compiled scripts are served from disk cache on later runs.
+    """
+
+    def __init__(
+        self,
+        account: str,
+        root: str = None,
+        cache_size_mb: int = 100,
+        max_age_days: int = 7,
+    ):
+        root = root or os.path.join(DATA_PATH, "chrome_profiles")
+        self.path = os.path.join(root, re.sub(r"[^0-9A-Za-z_-]", "_", account))
+        self._cache_size = cache_size_mb * 1024 * 1024
+        self._max_age = max_age_days * 24 * 3600
+        self._stats_path = os.path.join(self.path, "sgcc_profile_stats.json")
+        self.warm = False
+
+    def prepare(self):
+        """create the profile, evict the cache when it's too big or too old"""
+        os.makedirs(self.path, exist_ok=True)
+        for name in _LOCK_FILES:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+        stats = self._load_stats()
+        cache_dirs = [os.path.join(self.path, d) for d in _CACHE_DIRS]
+        # --disk-cache-size 不限制 Code Cache, 所以按总大小再检查一次
+        cache_size = sum(_dir_size(d) for d in cache_dirs)
+        last_eviction = stats.get("last_eviction", 0)
+        if cache_size > 2 * self._cache_size or (
+            last_eviction and time.time() - last_eviction > self._max_age
+        ):
+            logging.info(
+                "Evict browser cache of %s, size %.1f MB.", self.path, cache_size / 2**20
+            )
+            for d in cache_dirs:
+                shutil.rmtree(d, ignore_errors=True)
+            cache_size = 0
+            stats["last_eviction"] = time.time()
+        elif not last_eviction:
+            stats["last_eviction"] = time.time()
+        self._dump_stats(stats)
+        self.warm = cache_size > 0
+
+    def chrome_arguments(self):
+        return [
+            f"--user-data-dir={self.path}",
+            f"--disk-cache-size={self._cache_size}",
+        ]
+
+    def record_run(self, first_paint: float | None, fetch_time: float):
+        """keep cold and warm cache runs apart to compare them"""
+        if first_paint is None:
+            return
+        stats = self._load_stats()
+        mode = "warm" if self.warm else "cold"
+        entry = stats.setdefault(mode, {"count": 0, "first_paint": 0.0, "fetch_time": 0.0})
+        entry["count"] += 1
+        entry["first_paint"] += first_paint
+        entry["fetch_time"] += fetch_time
+        self._dump_stats(stats)
+
+        logging.info(
+            "Browser cache %s: first paint %.0f ms, fetch time %.1f s.",
+            mode,
+            first_paint,
+            fetch_time,
+        )
+        if "cold" in stats and "warm" in stats:
+            logging.info(
+                "Browser cache average, cold: %.0f ms / %.1f s, warm: %.0f ms / %.1f s.",
+                *(
+                    stats[m][k] / stats[m]["count"]
+                    for m in ("cold", "warm")
+                    for k in ("first_paint", "fetch_time")
+                ),
+            )
+
+    def _load_stats(self) -> dict:
+        try:
+            with open(self._stats_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _dump_stats(self, stats: dict):
+        try:
+            with open(self._stats_path, "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+        except OSError as e:
+            logging.debug("Fail to write profile stats: %s", e)
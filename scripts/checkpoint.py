@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import re
+import time
+import typing
+
+from const import *
+
+MISSING = object()
+
+
+class Checkpoint:
+    """
+    Results of the finished fetch stages of one account, kept on disk so that a
+    retry only redoes the failed user id and stage.
+
+    Stages are "login", "user_ids", and per user id "balance", "usage" and
+    "spooled". It only lives across the retries of one run, the caller clears
+    it when the run succeeds or gives up. A checkpoint older than ttl_hours is
+    left over from a crash and is discarded.
+    """
+
+    def __init__(self, account: str, persist: bool = True, ttl_hours: float = 6):
+        name = re.sub(r"[^0-9A-Za-z_-]", "_", account)
+        self._path = os.path.join(DATA_PATH, f"sgcc_checkpoint_{name}.json")
+        self._persist = persist
+        self._ttl = ttl_hours * 3600
+        self._data = self._load()
+
+    def _new(self) -> dict:
+        return {"started_at": time.time(), "user_ids": None, "users": {}, "retries": {}}
+
+    def _load(self) -> dict:
+        if not self._persist:
+            return self._new()
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self._new()
+        if time.time() - data.get("started_at", 0) > self._ttl:
+            logging.info("Discard checkpoint of an earlier run.")
+            return self._new()
+        logging.info(
+            "Resume from checkpoint, finished stages: %s",
+            {user_id: list(stages) for user_id, stages in data["users"].items()},
+        )
+        return data
+
+    def _dump(self):
+        if not self._persist:
+            return
+        try:
+            with open(self._path, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False)
+        except OSError as e:
+            logging.warning("Fail to write checkpoint %s: %s", self._path, e)
+
+    @property
+    def user_ids(self) -> typing.List[str] | None:
+        return self._data["user_ids"]
+
+    @user_ids.setter
+    def user_ids(self, user_ids: typing.List[str]):
+        self._data["user_ids"] = user_ids
+        self._dump()
+
+    def get(self, user_id: str, stage: str, default=MISSING):
+        return self._data["users"].get(user_id, {}).get(stage, default)
+
+    def set(self, user_id: str, stage: str, value):
+        self._data["users"].setdefault(user_id, {})[stage] = value
+        self._dump()
+
+    def failed(self, stage: str):
+        retries = self._data["retries"]
+        retries[stage] = retries.get(stage, 0) + 1
+        self._dump()
+
+    @property
+    def retries(self) -> typing.Dict[str, int]:
+        return dict(self._data["retries"])
+
+    def clear(self):
+        """the run finished, the next run starts from scratch"""
+        self._data = self._new()
+        if self._persist:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
@@ -1,10 +1,56 @@
+import functools
+import json
+import os
+import types
+import typing
 from enum import Enum
 
-# 国网电力官网
-LOGIN_URL = "https://www.95598.cn/osgweb/login"
-ELECTRIC_USAGE_URL = "https://www.95598.cn/osgweb/electricityCharge"
-BALANCE_URL = "https://www.95598.cn/osgweb/userAcc"
+# 国网电力官网, 可以通过 SGCC_PORTAL_URL 指向本地回放服务 (portal_replay.py)
+PORTAL_URL = os.getenv("SGCC_PORTAL_URL", "https://www.95598.cn").rstrip("/")
+LOGIN_URL = PORTAL_URL + "/osgweb/login"
+MY95598_URL = PORTAL_URL + "/osgweb/my95598"
+ELECTRIC_USAGE_URL = PORTAL_URL + "/osgweb/electricityCharge"
+BALANCE_URL = PORTAL_URL + "/osgweb/userAcc"
 
+# 国网网页端调用的数据接口, 用于 FETCH_MODE=api 时直接请求 JSON 数据
+# key 为数据类型, path 为接口路径, fields 为返回 JSON 中字段的路径(按顺序尝试)
+# 网页接口变动时可以通过环境变量 SGCC_API_ENDPOINTS (JSON) 覆盖
+API_ENDPOINTS = {
+    "balance": {
+        "path": "/api/osg-web0004/member/c24/f01",
+        "fields": {
+            "balance": ["data.list.0.sumMoney", "data.list.0.prepayBal"],
+            "arrears": ["data.list.0.historyOwe"],
+        },
+    },
+    "yearly": {
+        "path": "/api/osg-open-bc0001/member/c9/f02",
+        "fields": {
+            "usage": ["data.dataInfo.totalEleNum"],
+            "charge": ["data.dataInfo.totalEleCost"],
+        },
+    },
+    "monthly": {
+        "path": "/api/osg-open-bc0001/member/c9/f02",
+        "fields": {
+            "rows": ["data.mothEleList"],
+            "month": ["month"],
+            "usage": ["monthEleNum"],
+            "charge": ["monthEleCost"],
+        },
+    },
+    "daily": {
+        "path": "/api/osg-web0004/member/c24/f02",
+        "fields": {
+            "rows": ["data.sevenEleList"],
+            "day": ["day"],
+            "usage": ["dayElePq"],
+        },
+    },
+}
+
+# 持久化数据目录, add-on 和 docker 下为 /data
+DATA_PATH = "/data" if os.path.isdir("/data") else "."
 
 # Home Assistant
 SUPERVISOR_URL = "http://supervisor/core"
@@ -84,6 +130,24 @@ LASTDAILY_CHARGE_MSG = {
     "value_template": "{{ float(value) }}",
 }
 
+# 近日用电量, 最近 DATA_RETENTION_DAYS 天的用电量序列放在属性里: {"dates": [...], "values": [...]}
+DAILY_HISTORY_CONFIG_TOPIC = "homeassistant/sensor/sgcc_daily_usage_history/config"
+DAILY_HISTORY_MSG = {
+    "name": "近日用电量",
+    "unique_id": "sgcc_daily_usage_history_{user_id}",
+    "device_class": "energy",
+    "state_topic": "homeassistant/sensor/sgcc_daily_usage_history_{user_id}/state",
+    "unit_of_measurement": "kWh",
+    "icon": "mdi:chart-bar",
+    "json_attributes_topic": "homeassistant/sensor/sgcc_daily_usage_history_{user_id}/attr",
+    "json_attributes_template": "{{ value }}",
+    "value_template": "{{ float(value) }}",
+}
+# 只包含上次发布之后新增的日期, 格式同上, 供自动化或 Node-RED 增量订阅
+DAILY_HISTORY_APPEND_TOPIC = (
+    "homeassistant/sensor/sgcc_daily_usage_history_{user_id}/append"
+)
+
 # 当月用电量
 MONTH_USAGE_CONFIG_TOPIC = "homeassistant/sensor/sgcc_month_electricity_usage/config"
 MONTH_USAGE_MSG = {
@@ -148,6 +212,7 @@ class MQTT_MsgEnum(Enum):
     CURRENT_BALANCE_MSG = (CURRENT_BALANCE_MSG, CURRENT_BALANCE_CONFIG_TOPIC)
     LASTDAILY_USAGE_MSG = (LASTDAILY_USAGE_MSG, LASTDAILY_USAGE_CONFIG_TOPIC)
     LASTDAILY_CHARGE_MSG = (LASTDAILY_CHARGE_MSG, LASTDAILY_CHARGE_CONFIG_TOPIC)
+    DAILY_HISTORY_MSG = (DAILY_HISTORY_MSG, DAILY_HISTORY_CONFIG_TOPIC)
     MONTH_USAGE_MSG = (MONTH_USAGE_MSG, MONTH_USAGE_CONFIG_TOPIC)
     MONTH_CHARGE_MSG = (MONTH_CHARGE_MSG, MONTH_CHARGE_CONFIG_TOPIC)
     YEARLY_USAGE_MSG = (YEARLY_USAGE_MSG, YEARLY_USAGE_CONFIG_TOPIC)
@@ -157,10 +222,13 @@ class MQTT_MsgEnum(Enum):
 def get_message(msg_type: MQTT_MsgEnum, user_id: str):
     device_msg = SGCC_DEVICE_MSG.copy()
     device_msg["identifiers"] = f"sgcc_{user_id}"
-    device_msg["connections"][0][1] = device_msg["serial_number"] = user_id
+    # connections 是嵌套列表, 不能改共享的 SGCC_DEVICE_MSG
+    device_msg["connections"] = [[SGCC_DEVICE_MSG["connections"][0][0], user_id]]
+    device_msg["serial_number"] = user_id
 
     config_msg = msg_type.value[0].copy()
-    config_topic = msg_type.value[1]
+    # 每个户号单独的配置 topic, 共用时 broker 只保留最后一个户号的配置
+    config_topic = msg_type.value[1].rsplit("/", 1)[0] + f"_{user_id}/config"
 
     config_msg["device"] = device_msg
     config_msg["name"] = config_msg["name"] + f"_{user_id}"
@@ -176,3 +244,84 @@ def get_message(msg_type: MQTT_MsgEnum, user_id: str):
         config_msg["state_topic"],
         config_msg["json_attributes_topic"],
     )
+
+
+# 设备级自动发现 (Home Assistant 2024.11+): 每个户号一条消息包含全部传感器, 使用缩写的键
+DEVICE_DISCOVERY_TOPIC = "homeassistant/device/sgcc_{user_id}/config"
+SGCC_ORIGIN_MSG = {
+    "name": "sgcc_electricity",
+    "url": "https://github.com/ARC-MX/sgcc_electricity_new",
+}
+DISCOVERY_ABBREVIATIONS = {
+    "connections": "cns",
+    "device_class": "dev_cla",
+    "identifiers": "ids",
+    "icon": "ic",
+    "json_attributes_template": "json_attr_tpl",
+    "json_attributes_topic": "json_attr_t",
+    "manufacturer": "mf",
+    "model": "mdl",
+    "serial_number": "sn",
+    "state_class": "stat_cla",
+    "state_topic": "stat_t",
+    "unique_id": "uniq_id",
+    "unit_of_measurement": "unit_of_meas",
+    "value_template": "val_tpl",
+}
+
+
+def abbreviate(config: dict) -> dict:
+    return {DISCOVERY_ABBREVIATIONS.get(key, key): value for key, value in config.items()}
+
+
+def get_device_discovery(user_id: str):
+    """the device discovery topic and payload with every sensor of the user id"""
+    device = None
+    components = {}
+    for msg_type in MQTT_MsgEnum:
+        _, config_msg, _, _ = get_message(msg_type, user_id)
+        device = config_msg.pop("device")
+        components[config_msg["unique_id"]] = {"p": "sensor", **abbreviate(config_msg)}
+    return (
+        DEVICE_DISCOVERY_TOPIC.format(user_id=user_id),
+        {"dev": abbreviate(device), "o": SGCC_ORIGIN_MSG, "cmps": components},
+    )
+
+
+class SensorTopics(typing.NamedTuple):
+    config_topic: str
+    config: bytes
+    state_topic: str
+    attr_topic: str
+
+
+class UserTopics(typing.NamedTuple):
+    sensors: typing.Mapping[MQTT_MsgEnum, SensorTopics]
+    device_topic: str
+    device_config: bytes
+
+
+@functools.lru_cache(maxsize=None)
+def topics_for(user_id: str) -> UserTopics:
+    """
+    Topics and serialized discovery configs of a user id, built once and
+    shared read-only between publishers. Use this instead of get_message when
+    publishing.
+    """
+    sensors = {}
+    for msg_type in MQTT_MsgEnum:
+        config_topic, config_msg, state_topic, attr_topic = get_message(
+            msg_type, user_id
+        )
+        sensors[msg_type] = SensorTopics(
+            config_topic,
+            json.dumps(config_msg).encode("utf-8"),
+            state_topic,
+            attr_topic,
+        )
+    device_topic, device_msg = get_device_discovery(user_id)
+    return UserTopics(
+        types.MappingProxyType(sensors),
+        device_topic,
+        json.dumps(device_msg, separators=(",", ":")).encode("utf-8"),
+    )
@@ -2,9 +2,13 @@ import logging
 import os
 import re
 import time
+import threading
 
 import random
 import base64
+import contextlib
+import hashlib
+import json
 import typing
 
 from datetime import datetime
@@ -14,7 +18,19 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
+import dom_extract
+from api_fetcher import ApiError, ApiFetcher
+from browser_profile import BrowserProfile
+from checkpoint import MISSING, Checkpoint
+from metrics import METRICS
+from portal_replay import PortalRecorder
+from publish_cache import PublishCache
+from dom_extract import RoundTripCounter
+from dom_wait import EventWaiter
+from resource_filter import PageLoadStats, ResourceFilter, page_load_metrics
 from sensor_updator import MQTTSensorUpdator
+from session_store import SessionStore, wait_logged_in
+from spool import UpdateSpool
 from selenium.webdriver.remote.webdriver import WebDriver
 from selenium.types import WaitExcTypes
 from selenium.common import exceptions as sel_ex
@@ -40,16 +56,36 @@ def base64_to_PLI(base64_str: str):
 
 T = typing.TypeVar("T")
 
+# 多个账号同时登录时共用一个验证码样本目录
+_CAPTCHA_LABELS_LOCK = threading.Lock()
+
 
 class DataFetcher:
-    def __init__(self, username: str, password: str):
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        ignore_user_id: str = None,
+        mqtt_client_id: str = "sgcc",
+    ):
         if "PYTHON_IN_DOCKER" not in os.environ:
             import dotenv
 
             dotenv.load_dotenv(verbose=True)
         self._username = username
         self._password = password
+        self.__driver: WebDriver | None = None
         self.onnx = ONNX("./captcha.onnx")
+        # 保存通过验证的验证码图片和滑动距离, 用于 benchmark.py captcha
+        self._captcha_corpus = os.getenv("CAPTCHA_CORPUS_DIR")
+        self._updator: MQTTSensorUpdator | None = None
+        # 采集到的数据先写入本地, broker 可用时再发布
+        self._spool = UpdateSpool(
+            mqtt_client_id, int(os.getenv("MQTT_SPOOL_MAX_KB", 1024)) * 1024
+        )
+        # 每次成功登录用了多少次滑动
+        self._captcha_attempts = 0
+        self._captcha_logins = 0
 
         # 获取 ENABLE_DATABASE_STORAGE 的值，默认为 False
         # self.enable_database_storage = (
@@ -61,16 +97,97 @@ class DataFetcher:
         )
         self.RETRY_TIMES_LIMIT = int(os.getenv("RETRY_TIMES_LIMIT", 5))
         self.LOGIN_EXPECTED_TIME = int(os.getenv("LOGIN_EXPECTED_TIME", 10))
+        # 滑块验证码读取方式: canvas 直接读取像素, screenshot 截图
+        self.CAPTCHA_CAPTURE = os.getenv("CAPTCHA_CAPTURE", "canvas").lower()
         self.RETRY_WAIT_TIME_OFFSET_UNIT = int(
             os.getenv("RETRY_WAIT_TIME_OFFSET_UNIT", 10)
         )
-        self.IGNORE_USER_ID = os.getenv("IGNORE_USER_ID", "").split(",")
+        self.IGNORE_USER_ID = (
+            ignore_user_id
+            if ignore_user_id is not None
+            else os.getenv("IGNORE_USER_ID", "")
+        ).split(",")
+        self._mqtt_client_id = mqtt_client_id
+        # selenium: 网页抓取; api: 浏览器仅用于登录, 直接请求网页调用的 JSON 接口, 失败时回退到网页抓取
+        self.FETCH_MODE = os.getenv("FETCH_MODE", "selenium").lower()
+        # 每个页面只加载一次, 在页面内切换用户号, 而不是每个用户号都重新加载页面
+        self.PAGE_MAJOR_TRAVERSAL = (
+            os.getenv("PAGE_MAJOR_TRAVERSAL", "false").lower() == "true"
+        )
+        self._page_loads = 0
+        # 本次运行按户号获取的页面数, 逐个户号加载时每个都要加载一次页面
+        self._page_fetches = 0
+        # 用一次 execute_script 读取整个表格, 失败时回退到逐个元素读取
+        self.BULK_DOM_EXTRACT = os.getenv("BULK_DOM_EXTRACT", "true").lower() == "true"
+        self._round_trips: RoundTripCounter | None = None
+        # 用 MutationObserver 等待元素出现, 代替隐式等待和轮询
+        self.EVENT_DRIVEN_WAIT = os.getenv("EVENT_DRIVEN_WAIT", "true").lower() == "true"
+        self._waiter: EventWaiter | None = None
+        # 屏蔽统计脚本等无用资源, 登录后再屏蔽图片
+        self.BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "false").lower() == "true"
+        self._resource_filter: ResourceFilter | None = None
+        self._page_load_stats = PageLoadStats()
+        # 使用持久化的浏览器 profile 代替无痕模式, 第二次运行起可以使用缓存
+        self._profile: BrowserProfile | None = None
+        self._first_paint = None
+        if os.getenv("PERSISTENT_PROFILE", "false").lower() == "true":
+            if os.getenv("REMOTE_DRIVER"):
+                logging.warning("PERSISTENT_PROFILE is not supported by REMOTE_DRIVER.")
+            else:
+                self._profile = BrowserProfile(
+                    self._username,
+                    cache_size_mb=int(os.getenv("BROWSER_CACHE_SIZE_MB", 100)),
+                    max_age_days=int(os.getenv("BROWSER_CACHE_MAX_AGE_DAYS", 7)),
+                )
+        # 常驻模式: 多次运行和重试之间复用同一个浏览器
+        self.KEEP_BROWSER_ALIVE = (
+            os.getenv("KEEP_BROWSER_ALIVE", "false").lower() == "true"
+        )
+        self.BROWSER_MAX_RUNS = int(os.getenv("BROWSER_MAX_RUNS", 20))
+        self.BROWSER_MAX_MEMORY_MB = int(os.getenv("BROWSER_MAX_MEMORY_MB", 1024))
+        self._browser_runs = 0
+        self._driver_reused = False
+        # 录制国网页面, 用于本地回放测试 (portal_replay.py)
+        record_dir = os.getenv("SGCC_RECORD_DIR")
+        self._recorder = PortalRecorder(record_dir) if record_dir else None
+        # 当前选择的户号序号, 每个户号的页面分别录制
+        self._userid_index = 0
+        # 保存已完成阶段的数据, 重试时只重做失败的户号和阶段
+        self.ENABLE_CHECKPOINT = os.getenv("ENABLE_CHECKPOINT", "true").lower() == "true"
+        self._checkpoint = Checkpoint(self._username, persist=False)
+        # 保存登录后的 cookies, 下次运行时免登录和滑块验证
+        self._session_store = (
+            SessionStore.shared()
+            if os.getenv("ENABLE_SESSION_STORE", "true").lower() == "true"
+            else None
+        )
+
+    def _event_wait(self, by, key, timeout, multiple=False):
+        """
+        wait by MutationObserver, return None when the event wait is disabled or
+        not usable so the caller falls back to WebDriverWait
+        """
+        if not self.EVENT_DRIVEN_WAIT:
+            return None
+        try:
+            return self._waiter.wait(by, key, timeout, multiple=multiple)
+        except ValueError:
+            return None
+        except (sel_ex.TimeoutException, sel_ex.StaleElementReferenceException):
+            raise
+        except sel_ex.WebDriverException as e:
+            logging.debug("Event wait for %s failed, fall back to polling: %s", key, e)
+            return None
 
     # @staticmethod
     def _click_button(self, button_search_type, button_search_key, timeout=None):
         """wrapped click function, click only when the element is clickable"""
         if not timeout:
             timeout = self.DRIVER_IMPLICITY_WAIT_TIME
+        click_element = self._event_wait(button_search_type, button_search_key, timeout)
+        if click_element is not None:
+            self.__driver.execute_script("arguments[0].click();", click_element)
+            return
         click_element = WebDriverWait(
             self.__driver, self.DRIVER_IMPLICITY_WAIT_TIME
         ).until(EC.element_to_be_clickable((button_search_type, button_search_key)))
@@ -88,6 +205,9 @@ class DataFetcher:
 
         if not timeout:
             timeout = self.DRIVER_IMPLICITY_WAIT_TIME
+        elem = self._event_wait(button_search_type, button_search_key, timeout)
+        if elem is not None:
+            return elem
         if ignore_timeout:
             ignored_exceptions = list(ignored_exceptions)
             ignored_exceptions.append(sel_ex.TimeoutException)
@@ -110,6 +230,11 @@ class DataFetcher:
         """wrapped click function, click only when the elements is visible"""
         if not timeout:
             timeout = self.DRIVER_IMPLICITY_WAIT_TIME
+        elems = self._event_wait(
+            button_search_type, button_search_key, timeout, multiple=True
+        )
+        if elems is not None:
+            return elems
         if ignore_timeout:
             ignored_exceptions = list(ignored_exceptions)
             ignored_exceptions.append(sel_ex.TimeoutException)
@@ -145,9 +270,98 @@ class DataFetcher:
             xoffset=distance, yoffset=yoffset_random
         ).release().perform()
 
+    def _save_captcha_sample(self, image, slide_distance):
+        if not self._captcha_corpus:
+            return
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(np.ascontiguousarray(image[..., :3]))
+        name = datetime.now().strftime("%Y%m%d%H%M%S%f") + ".png"
+        labels_path = os.path.join(self._captcha_corpus, "labels.json")
+        try:
+            os.makedirs(self._captcha_corpus, exist_ok=True)
+            image.save(os.path.join(self._captcha_corpus, name))
+            with _CAPTCHA_LABELS_LOCK:
+                try:
+                    with open(labels_path, encoding="utf-8") as f:
+                        labels = json.load(f)
+                except FileNotFoundError:
+                    labels = {}
+                labels[name] = slide_distance
+                # 先写临时文件再替换, 中断时不会留下写了一半的 labels.json
+                tmp_path = labels_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(labels, f, indent=2)
+                os.replace(tmp_path, labels_path)
+        except (OSError, ValueError) as e:
+            # labels.json 损坏时不覆盖, 以免丢掉已有的标注
+            logging.warning("Fail to save captcha sample: %s", e)
+
+    def _slide_outcome(self):
+        """
+        "success" once redirected, "failed" as soon as the slider marks the
+        slide failed, otherwise the 95598 error message.
+        """
+
+        def outcome(driver):
+            if driver.current_url == MY95598_URL:
+                return "success"
+            state = dom_extract.slide_state(driver)
+            if state:
+                return "failed" if state.get("failed") else state["error"]
+            return False
+
+        try:
+            return WebDriverWait(
+                self.__driver,
+                self.DRIVER_IMPLICITY_WAIT_TIME,
+                poll_frequency=0.1,
+                ignored_exceptions=(sel_ex.JavascriptException,),
+            ).until(outcome)
+        except sel_ex.TimeoutException:
+            return "failed"
+
+    def _wait_slider_reset(self):
+        """the slider resets itself shortly after a failed slide"""
+        try:
+            WebDriverWait(self.__driver, 5, poll_frequency=0.1).until(
+                lambda driver: not dom_extract.slide_state(driver)
+            )
+        except sel_ex.TimeoutException:
+            logging.debug("The slider didn't reset after the failed slide.")
+        # 等待可能重新加载的图片画完
+        time.sleep(0.5)
+
+    def _captcha_image(self, elem):
+        """read the canvas pixels of the slider captcha, the element screenshot is the fallback"""
+        if self.CAPTCHA_CAPTURE == "canvas":
+            start = time.monotonic()
+            try:
+                pixels = dom_extract.canvas_pixels(self.__driver, elem)
+            except sel_ex.WebDriverException as e:
+                logging.info("Fail to read captcha canvas, take a screenshot: %s", e.msg)
+                pixels = None
+            if pixels is not None:
+                elapsed = time.monotonic() - start
+                METRICS.observe("captcha_capture_canvas", elapsed)
+                logging.info("Read captcha canvas in %.0f ms.", elapsed * 1000)
+                return pixels
+
+        start = time.monotonic()
+        image = base64_to_PLI(elem.screenshot_as_base64)
+        image.load()
+        elapsed = time.monotonic() - start
+        METRICS.observe("captcha_capture_screenshot", elapsed)
+        logging.info("Took captcha screenshot in %.0f ms.", elapsed * 1000)
+        return image
+
     def _init_webdriver(self):
         chrome_options = Options()
-        chrome_options.add_argument("--incognito")
+        if self._profile:
+            self._profile.prepare()
+            for argument in self._profile.chrome_arguments():
+                chrome_options.add_argument(argument)
+        else:
+            chrome_options.add_argument("--incognito")
         chrome_options.add_argument("--window-size=1920,1080")
         if os.getenv("WEBDRIVER_HEADLESS"):
             chrome_options.add_argument("--headless")
@@ -155,17 +369,33 @@ class DataFetcher:
         chrome_options.add_argument("--disable-gpu")
         chrome_options.add_argument("--disable-dev-shm-usage")
         chrome_options.add_argument("--disable-extensions")
+        if self.FETCH_MODE == "api":
+            # 通过 performance log 捕获网页发出的 XHR 请求
+            chrome_options.set_capability(
+                "goog:loggingPrefs", {"performance": "ALL"}
+            )
 
         remote_driver = os.getenv("REMOTE_DRIVER")
         if remote_driver:
-            self.__driver: WebDriver = WebDriver(remote_driver, options=chrome_options)
+            self.__driver = WebDriver(remote_driver, options=chrome_options)
         else:
             self.__driver = Chrome(
                 service=ChromeService(executable_path="/usr/bin/chromedriver"),
                 options=chrome_options,
             )
-        self.__driver.implicitly_wait(self.DRIVER_IMPLICITY_WAIT_TIME)
+        # 隐式等待会和显式等待叠加, 事件等待模式下关闭隐式等待
+        self.__driver.implicitly_wait(
+            0 if self.EVENT_DRIVEN_WAIT else self.DRIVER_IMPLICITY_WAIT_TIME
+        )
         self.__driver.maximize_window()
+        self._round_trips = RoundTripCounter(self.__driver)
+        self._waiter = EventWaiter(self.__driver)
+        if self.BLOCK_RESOURCES:
+            patterns = os.getenv("BLOCKED_URL_PATTERNS")
+            self._resource_filter = ResourceFilter(
+                self.__driver, patterns.split(",") if patterns else None
+            )
+            self._resource_filter.apply(block_images=False)
 
     def _wait(
         self,
@@ -193,13 +423,17 @@ class DataFetcher:
                 except sel_ex.NoSuchElementException:
                     return False
 
-            qr_code_elem = self._wait(wait_for_element, "fail to wait QR image")
+            qr_code_elem = self._wait(
+                wait_for_element,
+                "fail to wait QR image",
+                timeout=self.DRIVER_IMPLICITY_WAIT_TIME,
+            )
             ActionChains(self.__driver).move_to_element(qr_code_elem).perform()
             logging.info("Please scan the QR code within 30 seconds.")
 
             # wait for login success
             return WebDriverWait(self.__driver, 30).until(
-                EC.url_to_be("https://www.95598.cn/osgweb/my95598"),
+                EC.url_to_be(MY95598_URL),
                 "Waiting for scanning qrcode login failed to redirect to target page",
             )
 
@@ -226,97 +460,244 @@ class DataFetcher:
             self._click_button(By.CLASS_NAME, "el-button.el-button--primary")
             logging.info("Click login button.")
             # sometimes ddddOCR may fail, so add retry logic)
+            candidates = []
+            fingerprint = None
             for retry_times in range(1, self.RETRY_TIMES_LIMIT + 1):
                 im_info_elem = self._visible_elem(By.ID, "slideVerify")
-                background_image = base64_to_PLI(im_info_elem.screenshot_as_base64)
+                background_image = self._captcha_image(im_info_elem)
                 logging.info(f"Get electricity canvas image successfully.")
-                distance = self.onnx.get_distance(background_image)
-                logging.info(f"Image CaptCHA distance is {distance}.")
-                if distance <= 0:
+                self._record("login")
+                image_fingerprint = hashlib.md5(
+                    np.asarray(background_image).tobytes()
+                ).hexdigest()
+                if image_fingerprint != fingerprint:
+                    fingerprint = image_fingerprint
+                    with METRICS.timer("login_captcha_inference"):
+                        candidates = self.onnx.get_candidates(background_image)
+                    logging.info(f"Image CaptCHA gap candidates are {candidates}.")
+                elif candidates:
+                    # 验证失败后图片没有换, 直接试下一个候选位置
+                    logging.info("The captcha image is unchanged, try the next candidate.")
+                if not candidates:
+                    METRICS.inc("sgcc_captcha_attempts_total", result="no_gap")
                     logging.error(
-                        f"Image CaptCHA distance is {distance}, please check the image."
+                        f"No CaptCHA gap candidate left, refresh the image."
                     )
                     self._click_button(
                         By.XPATH, "//div[@class='slide-verify-refresh-icon']"
                     )
+                    fingerprint = None
                     time.sleep(2)
                     continue
 
-                self._sliding_track(round(distance * 1.06))  # 1.06是补偿
+                distance, confidence = candidates.pop(0)
+                self._captcha_attempts += 1
+                logging.info(
+                    f"Image CaptCHA distance is {distance}, confidence {confidence:.2f}."
+                )
+                slide = round(
+                    distance * self.onnx.slide_compensation(background_image)
+                )
+                with METRICS.timer("login_slider_drag"):
+                    self._sliding_track(slide)
                 # wait for login success
-                if WebDriverWait(self.__driver, self.DRIVER_IMPLICITY_WAIT_TIME).until(
-                    EC.url_to_be("https://www.95598.cn/osgweb/my95598")
-                ):
-                    logging.info(f"Sliding CAPTCHA recognition success, login success.")
+                with METRICS.timer("login_redirect_wait"):
+                    outcome = self._slide_outcome()
+                if outcome == "success":
+                    METRICS.inc("sgcc_captcha_attempts_total", result="success")
+                    self._save_captcha_sample(background_image, slide)
+                    METRICS.inc("sgcc_captcha_logins_total")
+                    self._captcha_logins += 1
+                    logging.info(
+                        "Sliding CAPTCHA recognition success, login success. "
+                        "%.1f attempts per login over %d logins.",
+                        self._captcha_attempts / self._captcha_logins,
+                        self._captcha_logins,
+                    )
                     return True
 
+                METRICS.inc("sgcc_captcha_attempts_total", result="failure")
+                if outcome != "failed":
+                    logging.error(f"Sliding CAPTCHA recognition failed, {outcome}")
+                    return False
                 logging.warning(
                     f"wait login success jump failed, retry times: {retry_times}"
                 )
-                err_msg = self._visible_elem(By.XPATH, "//div[@class='errmsg-tip']", 10)
-                if err_msg:
-                    err_msg = err_msg.text
-                    logging.error(f"Sliding CAPTCHA recognition failed, {err_msg}")
-                    return False
+                self._wait_slider_reset()
             return False
 
-        self.__driver.get(LOGIN_URL)
+        if self._driver_reused and self._is_logged_in():
+            logging.info("The reused webdriver is still logged in, skip login.")
+            return True
+        if self._resource_filter:
+            # 上次运行登录后屏蔽了图片, 重新登录需要加载验证码
+            self._resource_filter.apply(block_images=False)
+
+        if self._session_store and self._session_store.restore(
+            self._username, self.__driver, self.LOGIN_EXPECTED_TIME
+        ):
+            logging.info("Login session restored from session store, skip login.")
+            return True
+
+        self._open_page(LOGIN_URL)
         logging.info(f"Open LOGIN_URL:{LOGIN_URL}.")
 
         if scan_qr_code:
             try:
-                return login_by_scan_QR()
+                logged_in = login_by_scan_QR()
             except sel_ex.TimeoutException:
                 logging.info("fail to wait qr code scan, try login by password...")
-                return login_by_username_pw()
+                logged_in = login_by_username_pw()
         else:
-            return login_by_username_pw()
+            logged_in = login_by_username_pw()
+
+        if logged_in and self._session_store:
+            try:
+                self._session_store.save(self._username, self.__driver)
+            except sel_ex.WebDriverException as e:
+                logging.warning("Fail to save login session: %s", e)
+        return logged_in
 
     def __enter__(self):
+        if self.__driver and self._driver_healthy():
+            logging.info("Reuse the running webdriver, run %d.", self._browser_runs + 1)
+            self._driver_reused = True
+            return self
+        self.close()
         try:
-            self._init_webdriver()
+            with METRICS.timer("init_webdriver"):
+                self._init_webdriver()
         except sel_ex.WebDriverException as e:
             logging.error("fail to init webdriver", e)
             raise RuntimeError("fail to init webdriver, check config")
+        self._driver_reused = False
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._close_updator()
+        self._browser_runs += 1
+        if not self.KEEP_BROWSER_ALIVE:
+            self.close()
+            return
+        # 页面超时等异常时浏览器还可以继续用, 只有浏览器本身出错才重启
+        if exc_type is not None and not self._driver_healthy():
+            logging.warning("Webdriver failed (%s), restart it on next run.", exc_val)
+            self.close()
+        elif self._browser_runs >= self.BROWSER_MAX_RUNS:
+            logging.info("Webdriver served %d runs, recycle it.", self._browser_runs)
+            self.close()
+        else:
+            memory = self._browser_memory_mb()
+            if memory and memory > self.BROWSER_MAX_MEMORY_MB:
+                logging.info("Webdriver uses %.0f MB memory, recycle it.", memory)
+                self.close()
+
+    def _close_updator(self):
+        if self._updator:
+            self._updator.close()
+            self._updator = None
+
+    def close(self):
+        """quit the webdriver, safe to call when it's not running"""
+        self._close_updator()
+        driver, self.__driver = self.__driver, None
+        self._browser_runs = 0
+        if driver is None:
+            return
         try:
-            if self.__driver:
-                self.__driver.quit()
-            if self.connect:
-                self.connect.close()
+            driver.quit()
             logging.info("Webdriver closed.")
-        except:
-            pass
+        except Exception as e:
+            logging.debug("Fail to quit webdriver: %s", e)
+
+    def _driver_healthy(self) -> bool:
+        try:
+            return self.__driver.execute_script("return 1") == 1
+        except Exception as e:
+            logging.info("Webdriver health check failed: %s", e)
+            return False
+
+    def _browser_memory_mb(self) -> float | None:
+        """resident memory of chromedriver and its browser processes, local driver only"""
+        service = getattr(self.__driver, "service", None)
+        process = getattr(service, "process", None)
+        if process is None or not os.path.isdir("/proc"):
+            return None
+        children = {}
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # comm 字段可能带空格, 从最后一个 ")" 之后解析
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(pid))
+            except (OSError, IndexError, ValueError):
+                continue
+        total_kb, stack = 0, [process.pid]
+        while stack:
+            pid = stack.pop()
+            stack.extend(children.get(pid, []))
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total_kb += int(line.split()[1])
+                            break
+            except (OSError, ValueError):
+                continue
+        return total_kb / 1024
+
+    def _is_logged_in(self) -> bool:
+        """a reused browser may still hold a valid 95598 login"""
+        self.__driver.get(MY95598_URL)
+        return wait_logged_in(self.__driver, self.LOGIN_EXPECTED_TIME)
 
     def fetch(self):
         """main logic here"""
         logging.info("Webdriver initialized.")
-        updator = MQTTSensorUpdator(
-            os.getenv("MQTT_USERNAME"),
-            os.getenv("MQTT_PASSWORD"),
-            os.getenv("MQTT_HOST"),
-            int(os.getenv("MQTT_PORT", 1883)),
+        fetch_start = time.monotonic()
+        self._first_paint = None
+        self._round_trips.history.clear()
+        self._waiter.durations.clear()
+        checkpoint = self._checkpoint = Checkpoint(
+            self._username, persist=self.ENABLE_CHECKPOINT
         )
-        with updator:
-            if not updator.ping():
-                raise RuntimeError("mqtt not connected")
-
-        if self._login(
-            phone_code=bool(os.getenv("DEBUG_MODE")),
-            scan_qr_code=bool(os.getenv("SCAN_QR_CODE")),
+        # 整次运行共用一个 MQTT 连接, 在 __exit__ 中关闭
+        self._close_updator()
+        updator = self._updator = self._new_updator()
+        # 上次运行没有发布出去的数据
+        self._drain_spool(updator)
+
+        user_id_list = checkpoint.user_ids
+        if user_id_list is not None and all(
+            self._collected(user_id)
+            for user_id in user_id_list
+            if user_id not in self.IGNORE_USER_ID
         ):
-            logging.info("login successed !")
+            logging.info("All user data is in the checkpoint, skip login.")
         else:
-            logging.info("login unsuccessed !")
-            return
-
-        logging.info(f"Login successfully on {LOGIN_URL}")
-        logging.info(f"Try to get the userid list")
-        user_id_list = self._get_user_ids()
-        if not user_id_list:
-            raise RuntimeError("fail to get user_id list under this account")
+            with METRICS.timer("login"):
+                logged_in = self._login(
+                    phone_code=bool(os.getenv("DEBUG_MODE")),
+                    scan_qr_code=bool(os.getenv("SCAN_QR_CODE")),
+                )
+            if logged_in:
+                logging.info("login successed !")
+            else:
+                checkpoint.failed("login")
+                logging.info("login unsuccessed !")
+                raise RuntimeError("fail to login")
+
+            logging.info(f"Login successfully on {LOGIN_URL}")
+            if self._resource_filter:
+                # 登录完成, 不再需要验证码图片
+                self._resource_filter.apply(block_images=True)
+            if user_id_list is None:
+                logging.info(f"Try to get the userid list")
+                user_id_list = self._get_user_ids()
+                if not user_id_list:
+                    checkpoint.failed("user_ids")
+                    raise RuntimeError("fail to get user_id list under this account")
+                checkpoint.user_ids = user_id_list
 
         logging.info(
             "Here are a total of %d userids, which are %s among which %s will be ignored.",
@@ -324,48 +705,287 @@ class DataFetcher:
             user_id_list,
             self.IGNORE_USER_ID,
         )
+        users = []
         for userid_index, user_id in enumerate(user_id_list):
             if user_id in self.IGNORE_USER_ID:
                 logging.info("The user ID %s will be ignored in user_id_list", user_id)
                 continue
+            users.append((userid_index, user_id))
+
+        self._page_loads = 0
+        self._page_fetches = 0
+        pending_users = [user for user in users if not self._collected(user[1])]
+        api_fetcher = self._init_api_fetcher(user_id_list) if pending_users else None
+        page_major_data = None
+        if self.PAGE_MAJOR_TRAVERSAL and not api_fetcher:
+            page_major_data = self._get_all_data_page_major(users)
+
+        failed_users = []
+        for userid_index, user_id in users:
+            if checkpoint.get(user_id, "spooled", False):
+                logging.info("The user %s was collected by an earlier try.", user_id)
+                continue
             try:
-                # switch to electricity charge balance page
-                self.__driver.get(BALANCE_URL)
-                self._choose_current_userid(userid_index)
-
-                with updator:
-                    updator.publish_config(user_id)
+                if page_major_data is not None and user_id not in page_major_data:
+                    failed_users.append(user_id)
+                    continue
 
                 ### get data
                 data = (
-                    balance,
-                    last_daily_date,
-                    last_daily_usage,
-                    yearly_charge,
-                    yearly_usage,
-                    month_charge,
-                    month_usage,
-                    lastdays_usages,
-                ) = self._get_all_data(user_id, userid_index)
+                    page_major_data[user_id]
+                    if page_major_data is not None
+                    else self._get_user_data(user_id, userid_index, api_fetcher)
+                )
 
                 logging.debug("fetch data success, data %s", data)
-                with updator:
-                    updator.update_one_userid(
-                        user_id,
-                        balance,
-                        last_daily_date,
-                        last_daily_usage,
-                        yearly_charge,
-                        yearly_usage,
-                        month_charge,
-                        month_usage,
-                        lastdays_usages,
-                    )
-                logging.info("success update sensor for user_id: %s", user_id)
+                self._spool.append(user_id, data)
+                checkpoint.set(user_id, "spooled", True)
+                logging.info("success fetch data for user_id: %s", user_id)
             except (sel_ex.NoSuchElementException, sel_ex.TimeoutException) as e:
-                logging.info("The user %s data fetching failed, %e", user_id, e)
+                logging.info("The user %s data fetching failed, %s", user_id, e)
+                failed_users.append(user_id)
+        if api_fetcher:
+            api_fetcher.close()
+        self._drain_spool(updator)
+        if page_major_data is not None:
+            logging.info(
+                "Loaded %d portal pages to read %d user id pages, %d page loads saved by page-major traversal.",
+                self._page_loads,
+                self._page_fetches,
+                self._page_fetches - self._page_loads,
+            )
+        logging.info(
+            "WebDriver round trips per extraction: %s", self._round_trips.summary()
+        )
+        if self._profile:
+            self._profile.record_run(self._first_paint, time.monotonic() - fetch_start)
+        if self._waiter.durations:
+            logging.info(
+                "Waited %d steps, median wait %.2fs.",
+                len(self._waiter.durations),
+                self._waiter.median(),
+            )
+        if checkpoint.retries:
+            logging.info("Retries per stage: %s", checkpoint.retries)
+        if failed_users:
+            raise RuntimeError(f"fail to fetch data of user ids {failed_users}")
+        checkpoint.clear()
         logging.info("run fetch task has completed.")
 
+    def _new_updator(self) -> MQTTSensorUpdator:
+        return MQTTSensorUpdator(
+            os.getenv("MQTT_USERNAME"),
+            os.getenv("MQTT_PASSWORD"),
+            os.getenv("MQTT_HOST"),
+            int(os.getenv("MQTT_PORT", 1883)),
+            client_id=self._mqtt_client_id,
+            max_inflight=int(os.getenv("MQTT_MAX_INFLIGHT", 20)),
+            qos=int(os.getenv("MQTT_QOS", 0)),
+            cache=(
+                PublishCache(
+                    self._mqtt_client_id,
+                    float(os.getenv("MQTT_RESYNC_HOURS", 24)),
+                )
+                if os.getenv("MQTT_PUBLISH_CACHE", "true").lower() == "true"
+                else None
+            ),
+            discovery=os.getenv("MQTT_DISCOVERY", "sensor").lower(),
+            series_resync_hours=float(os.getenv("MQTT_RESYNC_HOURS", 24)),
+        )
+
+    def drain_spool(self):
+        """publish the updates spooled during a broker outage between two runs"""
+        if not len(self._spool):
+            return
+        updator = self._new_updator()
+        try:
+            self._drain_spool(updator)
+        finally:
+            updator.close()
+
+    def _drain_spool(self, updator: MQTTSensorUpdator):
+        """publish the spooled updates, they stay in the spool while the broker is unreachable"""
+
+        def publish(user_id, data):
+            with updator:
+                updator.publish_config(user_id)
+                updator.update_one_userid(user_id, *data)
+
+        try:
+            with METRICS.timer("mqtt_drain"):
+                published = self._spool.drain(publish)
+        except Exception as e:
+            # 下次发布时重新连接
+            updator.close()
+            logging.warning(
+                "MQTT broker unavailable, %d updates kept in the spool: %s",
+                len(self._spool),
+                e,
+            )
+            return
+        if published:
+            logging.info("Published %d spooled sensor updates.", published)
+
+    def discard_checkpoint(self):
+        """the retries gave up, the next run must not resume from stale data"""
+        Checkpoint(self._username, persist=self.ENABLE_CHECKPOINT).clear()
+
+    def _collected(self, user_id) -> bool:
+        return (
+            self._checkpoint.get(user_id, "balance") is not MISSING
+            and self._checkpoint.get(user_id, "usage") is not MISSING
+        )
+
+    @contextlib.contextmanager
+    def _measure(self, name):
+        """count webdriver round trips and time one extraction"""
+        with self._round_trips.measure(name), METRICS.timer(f"get_{name}"):
+            yield
+
+    @contextlib.contextmanager
+    def _stage(self, stage):
+        """count the failures of a fetch stage in the checkpoint"""
+        try:
+            yield
+        except Exception:
+            self._checkpoint.failed(stage)
+            raise
+
+    def _record(self, name):
+        if self._recorder:
+            self._recorder.snapshot(self.__driver, name)
+
+    def _open_page(self, url):
+        self.__driver.get(url)
+        self._page_loads += 1
+        metrics = page_load_metrics(self.__driver)
+        self._page_load_stats.record(url, self.BLOCK_RESOURCES, metrics)
+        if self._first_paint is None and metrics:
+            self._first_paint = metrics.get("first_paint")
+
+    def _init_api_fetcher(self, user_id_list) -> ApiFetcher | None:
+        """open the data pages once so the SPA fires its XHR calls, then capture them"""
+        if self.FETCH_MODE != "api":
+            return None
+        try:
+            self._open_page(BALANCE_URL)
+            self._visible_elem(By.CLASS_NAME, "num")
+            self._open_page(ELECTRIC_USAGE_URL)
+            self._visible_elem(By.CLASS_NAME, "total")
+            self._click_button(
+                By.XPATH, "//div[@class='el-tabs__nav is-top']/div[@id='tab-second']"
+            )
+            self._visible_elems(
+                By.XPATH,
+                "//div[@class='el-tab-pane dayd']//div[@class='el-table__body-wrapper is-scrolling-none']/table/tbody/tr[1]/td/div",
+            )
+        except sel_ex.WebDriverException as e:
+            logging.warning("Fail to open data pages for api capture: %s", e)
+        try:
+            api_fetcher = ApiFetcher.from_driver(
+                self.__driver, user_id_list, timeout=self.DRIVER_IMPLICITY_WAIT_TIME
+            )
+        except (ApiError, sel_ex.WebDriverException) as e:
+            logging.warning("Fail to capture 95598 api, fall back to webpage: %s", e)
+            return None
+        logging.info("Captured 95598 api, fetch data by api.")
+        return api_fetcher
+
+    def _get_user_data(self, user_id, userid_index, api_fetcher: ApiFetcher | None):
+        if api_fetcher and not self._collected(user_id):
+            try:
+                data = api_fetcher.get_all_data(user_id)
+                logging.info("Get data for %s by api successfully.", user_id)
+                self._checkpoint.set(user_id, "balance", data[0])
+                self._checkpoint.set(user_id, "usage", data[1:])
+                return data
+            except ApiError as e:
+                logging.warning(
+                    "Get data for %s by api failed, fall back to webpage: %s", user_id, e
+                )
+        return self._get_all_data(user_id, userid_index)
+
+    def _get_all_data_page_major(self, users) -> dict:
+        """
+        Load the balance and usage pages once each and switch between user ids
+        with the in-page dropdown, instead of reloading both pages per user id.
+
+        :return: data of every successfully fetched user id, same layout as _get_all_data
+        """
+        checkpoint = self._checkpoint
+        pending = [u for u in users if checkpoint.get(u[1], "balance") is MISSING]
+        self._page_fetches += len(pending)
+        if pending:
+            self._open_page(BALANCE_URL)
+        for userid_index, user_id in pending:
+            try:
+                with self._stage("balance"):
+                    self._switch_userid_in_page(
+                        BALANCE_URL, userid_index, user_id, "num"
+                    )
+                    checkpoint.set(user_id, "balance", self._get_balance_data(user_id))
+            except (sel_ex.NoSuchElementException, sel_ex.TimeoutException) as e:
+                logging.info("The user %s balance fetching failed, %s", user_id, e)
+
+        pending = [u for u in users if checkpoint.get(u[1], "usage") is MISSING]
+        self._page_fetches += len(pending)
+        if pending:
+            self._open_page(ELECTRIC_USAGE_URL)
+        for userid_index, user_id in pending:
+            try:
+                with self._stage("usage"):
+                    self._switch_userid_in_page(
+                        ELECTRIC_USAGE_URL, userid_index, user_id, "total"
+                    )
+                    checkpoint.set(user_id, "usage", self._get_usage_data(user_id))
+            except (sel_ex.NoSuchElementException, sel_ex.TimeoutException) as e:
+                logging.info("The user %s data fetching failed, %s", user_id, e)
+
+        return {
+            user_id: (checkpoint.get(user_id, "balance"),)
+            + tuple(checkpoint.get(user_id, "usage"))
+            for _, user_id in users
+            if self._collected(user_id)
+        }
+
+    def _selected_userid(self, user_id) -> bool:
+        """the user id dropdown shows user_id"""
+        return any(
+            user_id in (elem.get_attribute("value") or "")
+            for elem in self.__driver.find_elements(
+                By.CSS_SELECTOR, ".el-select .el-input__inner"
+            )
+        )
+
+    def _marker_text(self, marker_class) -> str:
+        elems = self.__driver.find_elements(By.CLASS_NAME, marker_class)
+        return elems[0].text if elems else ""
+
+    def _switch_userid_in_page(self, url, userid_index, user_id, marker_class):
+        """
+        choose the user id in the dropdown and wait until the page shows it and
+        the data in marker_class changed, reload the page for the user id when
+        that doesn't happen in time
+        """
+        if self._selected_userid(user_id):
+            # 刚打开页面时已经选中第一个户号
+            return
+        old_text = self._marker_text(marker_class)
+        self._choose_current_userid(userid_index)
+        try:
+            self._wait(
+                lambda d: self._selected_userid(user_id)
+                and self._marker_text(marker_class) not in ("", old_text),
+                timeout=self.DRIVER_IMPLICITY_WAIT_TIME,
+            )
+        except sel_ex.TimeoutException:
+            # 数据没变可能是还没加载完, 也可能和上一个户号相同, 重新加载页面更可靠
+            logging.info(
+                "Page didn't switch to user %s in time, reload the page.", user_id
+            )
+            self._open_page(url)
+            self._choose_current_userid(userid_index)
+
     def _get_current_userid(self):
         return self.__driver.find_element(
             By.XPATH,
@@ -373,6 +993,7 @@ class DataFetcher:
         ).text
 
     def _choose_current_userid(self, userid_index):
+        self._userid_index = userid_index
         elements = self.__driver.find_elements(By.CLASS_NAME, "button_confirm")
         if elements:
             self._click_button(
@@ -385,7 +1006,29 @@ class DataFetcher:
         )
 
     def _get_all_data(self, user_id, userid_index):
-        balance = self._get_electric_balance()
+        balance = self._checkpoint.get(user_id, "balance")
+        if balance is MISSING:
+            with self._stage("balance"):
+                # switch to electricity charge balance page
+                self._open_page(BALANCE_URL)
+                self._choose_current_userid(userid_index)
+                balance = self._get_balance_data(user_id)
+            self._checkpoint.set(user_id, "balance", balance)
+
+        usage = self._checkpoint.get(user_id, "usage")
+        if usage is MISSING:
+            with self._stage("usage"):
+                # swithc to electricity usage page
+                self._open_page(ELECTRIC_USAGE_URL)
+                self._choose_current_userid(userid_index)
+                usage = self._get_usage_data(user_id)
+            self._checkpoint.set(user_id, "usage", usage)
+        return (balance,) + tuple(usage)
+
+    def _get_balance_data(self, user_id):
+        with self._measure("balance"):
+            balance = self._get_electric_balance()
+        self._record(f"userAcc.{self._userid_index}")
         if balance is None:
             logging.warning(
                 f"Get electricity charge balance for {user_id} failed, Pass."
@@ -394,11 +1037,13 @@ class DataFetcher:
             logging.info(
                 f"Get electricity charge balance for {user_id} successfully, balance is {balance} CNY."
             )
-        # swithc to electricity usage page
-        self.__driver.get(ELECTRIC_USAGE_URL)
-        self._choose_current_userid(userid_index)
+        return balance
+
+    def _get_usage_data(self, user_id):
+        """read usage data of the current user id on the usage page"""
         # get data for each user id
-        yearly_usage, yearly_charge = self._get_yearly_data()
+        with self._measure("yearly"):
+            yearly_usage, yearly_charge = self._get_yearly_data()
 
         if yearly_usage is None:
             logging.error(f"Get year power usage for {user_id} failed, pass")
@@ -406,25 +1051,29 @@ class DataFetcher:
             logging.error(f"Get year power charge for {user_id} failed, pass")
 
         # 按月获取数据
-        month, month_usage, month_charge = self._get_month_usage()
+        with self._measure("month"):
+            month, month_usage, month_charge = self._get_month_usage()
         if month is None:
             logging.error(f"Get month power usage for {user_id} failed, pass")
 
         # get yesterday usage
-        last_daily_date, last_daily_usage = self._get_yesterday_usage()
+        with self._measure("yesterday"):
+            last_daily_date, last_daily_usage = self._get_yesterday_usage()
         if last_daily_usage is None:
             logging.error(f"Get daily power consumption for {user_id} failed, pass")
 
         last_days_usages = None
         # 按天获取数据 7天/30天
         if os.getenv("DATA_RETENTION_DAYS"):
-            last_days_usages = self._get_daily_usage_data()
+            with self._measure("daily"):
+                last_days_usages = self._get_daily_usage_data()
+
+        self._record(f"electricityCharge.{self._userid_index}")
 
         month_charge = float(month_charge[-1]) if month_charge else None
         month_usage = float(month_usage[-1]) if month_usage else None
 
         return (
-            balance,
             last_daily_date,
             last_daily_usage,
             yearly_charge,
@@ -437,7 +1086,10 @@ class DataFetcher:
     def _get_user_ids(self):
         try:
             # 刷新网页
-            element = self._wait(EC.presence_of_element_located((By.CLASS_NAME, "el-dropdown")))
+            element = self._wait(
+                EC.presence_of_element_located((By.CLASS_NAME, "el-dropdown")),
+                timeout=self.DRIVER_IMPLICITY_WAIT_TIME,
+            )
             # click roll down button for user id
             self._click_button(By.XPATH, "//div[@class='el-dropdown']/span")
 
@@ -447,7 +1099,8 @@ class DataFetcher:
             self._wait(
                 EC.text_to_be_present_in_element(
                     (By.XPATH, "//ul[@class='el-dropdown-menu el-popper']/li"), ":"
-                )
+                ),
+                timeout=self.DRIVER_IMPLICITY_WAIT_TIME,
             )
             # get user id one by one
             userid_elements = self.__driver.find_element(
@@ -456,6 +1109,7 @@ class DataFetcher:
             userid_list = []
             for element in userid_elements:
                 userid_list.append(re.findall("[0-9]+", element.text)[-1])
+            self._record("my95598")
             return userid_list
         except Exception as e:
             logging.error(
@@ -463,6 +1117,21 @@ class DataFetcher:
             )
 
     def _get_electric_balance(self):
+        try:
+            self._visible_elem(By.CLASS_NAME, "num")
+        except sel_ex.TimeoutException:
+            return None
+        if self.BULK_DOM_EXTRACT:
+            try:
+                balance, balance_text = dom_extract.texts(
+                    self.__driver,
+                    dom_extract.class_xpath("num"),
+                    dom_extract.class_xpath("amttxt"),
+                )
+                if balance and balance_text is not None:
+                    return -float(balance) if "欠费" in balance_text else float(balance)
+            except (sel_ex.WebDriverException, ValueError) as e:
+                logging.debug("Bulk extract balance failed, fall back: %s", e)
         try:
             balance = self.__driver.find_element(By.CLASS_NAME, "num").text
             balance_text = self.__driver.find_element(By.CLASS_NAME, "amttxt").text
@@ -489,6 +1158,18 @@ class DataFetcher:
             logging.error("The yearly data get failed %s", e)
             return None, None
 
+        if self.BULK_DOM_EXTRACT:
+            try:
+                yearly_usage, yearly_charge = dom_extract.texts(
+                    self.__driver,
+                    "//ul[@class='total']/li[1]/span",
+                    "//ul[@class='total']/li[2]/span",
+                )
+                if yearly_usage and yearly_charge:
+                    return float(yearly_usage), float(yearly_charge)
+            except (sel_ex.WebDriverException, ValueError) as e:
+                logging.debug("Bulk extract yearly data failed, fall back: %s", e)
+
         # get data
         try:
             yearly_usage = self._visible_elem(
@@ -516,6 +1197,15 @@ class DataFetcher:
                 By.XPATH, "//div[@class='el-tabs__nav is-top']/div[@id='tab-second']"
             )
 
+            if self.BULK_DOM_EXTRACT:
+                self._visible_elem(
+                    By.XPATH,
+                    "//div[@class='el-tab-pane dayd']//div[@class='el-table__body-wrapper is-scrolling-none']/table/tbody/tr[1]/td[2]/div",
+                )
+                latest = self._bulk_daily_rows("tr[1]")
+                if latest:
+                    return latest[0]
+
             # 增加是哪一天
             date_elements = self._visible_elems(
                 By.XPATH,
@@ -537,7 +1227,7 @@ class DataFetcher:
                 self._click_button(
                     By.XPATH, '//*[@id="pane-first"]/div[1]/div/div[1]/div/div/input'
                 )
-                span_element = self.__driver.find_element(
+                span_element = self._visible_elem(
                     By.XPATH, f"//span[contains(text(), '{datetime.now().year - 1}')]"
                 )
                 span_element.click()
@@ -546,6 +1236,18 @@ class DataFetcher:
                 By.CLASS_NAME,
                 "total",
             )
+            if self.BULK_DOM_EXTRACT:
+                try:
+                    rows = dom_extract.table_rows(
+                        self.__driver,
+                        "//*[@id='pane-first']/div[1]/div[2]/div[2]/div/div[3]/table/tbody/tr",
+                    )
+                    if rows and all(len(row) == 3 for row in rows):
+                        month, usage, charge = (list(col) for col in zip(*rows))
+                        return month, usage, charge
+                except sel_ex.WebDriverException as e:
+                    logging.debug("Bulk extract month data failed, fall back: %s", e)
+
             month_element = self._visible_elem(
                 By.XPATH,
                 "//*[@id='pane-first']/div[1]/div[2]/div[2]/div/div[3]/table/tbody",
@@ -595,6 +1297,11 @@ class DataFetcher:
         )
         self._visible_elem(*usage_element)
 
+        if self.BULK_DOM_EXTRACT:
+            lastdays_usage = self._bulk_daily_rows("tr")
+            if lastdays_usage is not None:
+                return lastdays_usage
+
         # 获取用电量的数据
         days_element = self._visible_elems(
             By.XPATH,
@@ -609,3 +1316,17 @@ class DataFetcher:
             if usage != "":
                 lastdays_usage.append((day, float(usage)))
         return lastdays_usage
+
+    def _bulk_daily_rows(self, rows) -> typing.List[typing.Tuple[str, float]] | None:
+        """read (day, usage) of the daily usage table in one script call, None on failure"""
+        try:
+            rows = dom_extract.table_rows(
+                self.__driver,
+                f"//*[@id='pane-second']/div[2]/div[2]/div[1]/div[3]/table/tbody/{rows}",
+            )
+            if not rows or any(len(row) < 2 for row in rows):
+                return None
+            return [(row[0], float(row[1])) for row in rows if row[1] != ""]
+        except (sel_ex.WebDriverException, ValueError) as e:
+            logging.debug("Bulk extract daily usage failed, fall back: %s", e)
+            return None
@@ -0,0 +1,143 @@
+import base64
+import collections
+import contextlib
+import logging
+import typing
+
+import numpy as np
+from selenium.webdriver.remote.webdriver import WebDriver
+
+# 一次 execute_script 读取整个表格, 每行返回各单元格的文本
+_TABLE_ROWS_SCRIPT = """
+const [xpath, ignored] = arguments;
+const result = document.evaluate(xpath, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+const rows = [];
+for (let i = 0; i < result.snapshotLength; i++) {
+    const cells = result.snapshotItem(i).querySelectorAll("td");
+    rows.push(Array.from(cells, (cell) => {
+        const lines = cell.innerText.split("\\n").map((s) => s.trim());
+        return lines.filter((s) => s && !ignored.includes(s)).join(" ");
+    }));
+}
+return rows;
+"""
+
+# 一次 execute_script 读取多个元素的文本, 找不到的元素返回 null
+_TEXTS_SCRIPT = """
+return arguments[0].map((xpath) => {
+    const node = document.evaluate(xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    return node ? node.innerText.trim() : null;
+});
+"""
+
+# 把元素内的 canvas 按页面上的位置画到一起, 返回 RGBA 原始像素的 base64, 不经过截图和 PNG 编码
+_CANVAS_PIXELS_SCRIPT = """
+const container = arguments[0];
+const canvases = container.tagName === "CANVAS" ? [container] : Array.from(container.querySelectorAll("canvas"));
+if (!canvases.length) {
+    return null;
+}
+const scale = window.devicePixelRatio || 1;
+const rect = container.getBoundingClientRect();
+const out = document.createElement("canvas");
+out.width = Math.round(rect.width * scale);
+out.height = Math.round(rect.height * scale);
+const ctx = out.getContext("2d");
+ctx.fillStyle = "#fff";
+ctx.fillRect(0, 0, out.width, out.height);
+for (const canvas of canvases) {
+    const r = canvas.getBoundingClientRect();
+    if (r.width && r.height) {
+        ctx.drawImage(canvas, (r.left - rect.left) * scale, (r.top - rect.top) * scale, r.width * scale, r.height * scale);
+    }
+}
+const data = ctx.getImageData(0, 0, out.width, out.height).data;
+let binary = "";
+for (let i = 0; i < data.length; i += 0x8000) {
+    binary += String.fromCharCode.apply(null, data.subarray(i, i + 0x8000));
+}
+return [out.width, out.height, btoa(binary)];
+"""
+
+# 滑块验证码的状态: 验证失败时滑块加上 container-fail, 国网的错误提示在 errmsg-tip
+_SLIDE_STATE_SCRIPT = """
+const error = Array.from(document.querySelectorAll(".errmsg-tip")).find(
+    (node) => node.getClientRects().length && node.innerText.trim()
+);
+if (error) {
+    return {error: error.innerText.trim()};
+}
+if (document.querySelector(".slide-verify-slider.container-fail")) {
+    return {failed: true};
+}
+return null;
+"""
+
+
+def class_xpath(class_name: str) -> str:
+    """xpath equivalent of By.CLASS_NAME"""
+    return f"//*[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+
+
+def table_rows(
+    driver: WebDriver, rows_xpath: str, ignored: typing.Iterable[str] = ("MAX",)
+) -> typing.List[typing.List[str]]:
+    """text of every cell in the rows matched by rows_xpath, one round trip"""
+    return driver.execute_script(_TABLE_ROWS_SCRIPT, rows_xpath, list(ignored)) or []
+
+
+def texts(driver: WebDriver, *xpaths: str) -> typing.List[str | None]:
+    """text of the first element matched by each xpath, one round trip"""
+    return driver.execute_script(_TEXTS_SCRIPT, list(xpaths))
+
+
+def canvas_pixels(driver: WebDriver, element) -> np.ndarray | None:
+    """
+    [h, w, 4] RGBA pixels of the canvases inside element as shown on the page,
+    one round trip. None when there is no canvas.
+    :raise JavascriptException: the canvas is tainted by a cross-origin image.
+    """
+    result = driver.execute_script(_CANVAS_PIXELS_SCRIPT, element)
+    if not result:
+        return None
+    width, height, data = result
+    return np.frombuffer(base64.b64decode(data), dtype=np.uint8).reshape(
+        height, width, 4
+    )
+
+
+def slide_state(driver: WebDriver) -> dict | None:
+    """{"failed": True} when the slider rejected the slide, {"error": text} on a 95598 error"""
+    return driver.execute_script(_SLIDE_STATE_SCRIPT)
+
+
+class RoundTripCounter:
+    """
+    Count WebDriver commands sent to the (possibly remote) driver, every command
+    is a HTTP round trip to chromedriver or Selenium Grid.
+    """
+
+    def __init__(self, driver: WebDriver):
+        self.count = 0
+        self.history = collections.defaultdict(list)
+        execute = driver.execute
+
+        def counting_execute(driver_command, params=None):
+            self.count += 1
+            return execute(driver_command, params)
+
+        # WebElement 也是通过 parent.execute 发送命令, 所以会一起计数
+        driver.execute = counting_execute
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        start = self.count
+        try:
+            yield
+        finally:
+            round_trips = self.count - start
+            self.history[name].append(round_trips)
+            logging.debug("Extract %s took %d webdriver round trips.", name, round_trips)
+
+    def summary(self) -> typing.Dict[str, int]:
+        return {name: sum(counts) for name, counts in self.history.items()}
@@ -0,0 +1,167 @@
+import logging
+import statistics
+import time
+import typing
+
+from selenium.common import exceptions as sel_ex
+from selenium.webdriver.common.by import By
+from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.remote.webelement import WebElement
+
+# 国网页面出错时显示的提示
+ERROR_SELECTOR = ("css", ".errmsg-tip")
+
+# 目标元素出现(或错误提示出现)时立即返回, 不再轮询
+_WAIT_SCRIPT = """
+const [kind, selector, text, errorSelector, visibleOnly, timeoutMs, done] = arguments;
+const query = (kind, selector) => {
+    if (kind === "css") {
+        return Array.from(document.querySelectorAll(selector));
+    }
+    const result = document.evaluate(selector, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    const nodes = [];
+    for (let i = 0; i < result.snapshotLength; i++) {
+        nodes.push(result.snapshotItem(i));
+    }
+    return nodes;
+};
+const isVisible = (node) => {
+    if (!(node instanceof Element) || !node.getClientRects().length) {
+        return false;
+    }
+    const style = window.getComputedStyle(node);
+    return style.visibility !== "hidden" && style.display !== "none" && style.opacity !== "0";
+};
+const check = () => {
+    if (errorSelector) {
+        const error = query(errorSelector[0], errorSelector[1]).find(
+            (node) => isVisible(node) && node.innerText.trim()
+        );
+        if (error) {
+            return {error: error.innerText.trim()};
+        }
+    }
+    const nodes = query(kind, selector).filter(
+        (node) => (!visibleOnly || isVisible(node)) && (!text || (node.innerText || "").includes(text))
+    );
+    return nodes.length ? {nodes: nodes} : null;
+};
+
+let result = check();
+if (result) {
+    done(result);
+    return;
+}
+let pending = false;
+const observer = new MutationObserver(() => {
+    if (pending) {
+        return;
+    }
+    // 合并同一轮的多次 DOM 变化, 只检查一次
+    pending = true;
+    Promise.resolve().then(() => {
+        pending = false;
+        const result = check();
+        if (result) {
+            finish(result);
+        }
+    });
+});
+const timer = setTimeout(() => finish({timeout: true}), timeoutMs);
+const finish = (result) => {
+    observer.disconnect();
+    clearTimeout(timer);
+    done(result);
+};
+observer.observe(document.documentElement, {
+    childList: true, subtree: true, attributes: true, characterData: true,
+});
+"""
+
+
+class PortalError(sel_ex.TimeoutException):
+    """95598 showed an error message while waiting, no need to wait any longer"""
+
+
+def to_selector(by: str, key: str) -> typing.Tuple[str, str] | None:
+    if by == By.XPATH:
+        return "xpath", key
+    if by == By.CSS_SELECTOR:
+        return "css", key
+    if by == By.ID:
+        return "css", f"[id='{key}']"
+    if by == By.CLASS_NAME:
+        # selenium 也允许 "a.b" 形式的复合 class
+        return "css", "." + key
+    if by == By.TAG_NAME:
+        return "css", key
+    return None
+
+
+class EventWaiter:
+    """
+    Wait for elements with a MutationObserver inside the page through
+    execute_async_script, which resolves as soon as the DOM changes instead of
+    polling the driver.
+    """
+
+    def __init__(self, driver: WebDriver):
+        self._driver = driver
+        self.durations: typing.List[float] = []
+
+    def wait(
+        self,
+        by: str,
+        key: str,
+        timeout: float,
+        text: str = None,
+        visible: bool = True,
+        multiple: bool = False,
+        error_selector=ERROR_SELECTOR,
+    ) -> WebElement | typing.List[WebElement]:
+        """
+        :raise PortalError: a 95598 error message appeared before the element.
+        :raise TimeoutException: the element didn't appear within timeout.
+        :raise ValueError: the locator can't be watched, use WebDriverWait instead.
+        """
+        selector = to_selector(by, key)
+        if selector is None:
+            raise ValueError(f"unsupported locator {by}")
+        if error_selector and error_selector[1].lstrip(".") in selector[1]:
+            # 等待的就是错误提示本身
+            error_selector = None
+
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise sel_ex.TimeoutException(f"wait for {key} timeout")
+            # 留出余量, 避免先触发 driver 的 script timeout
+            self._driver.set_script_timeout(remaining + 5)
+            try:
+                result = self._driver.execute_async_script(
+                    _WAIT_SCRIPT,
+                    selector[0],
+                    selector[1],
+                    text,
+                    list(error_selector) if error_selector else None,
+                    visible,
+                    int(remaining * 1000),
+                )
+            except sel_ex.JavascriptException as e:
+                # 等待期间页面跳转, 脚本上下文被销毁, 在新页面上继续等待
+                logging.debug("Wait script interrupted, wait again: %s", e.msg)
+                time.sleep(0.1)
+                continue
+            break
+
+        self.durations.append(time.monotonic() - start)
+        if result.get("error"):
+            raise PortalError(result["error"])
+        if result.get("timeout"):
+            raise sel_ex.TimeoutException(f"wait for {key} timeout")
+        return result["nodes"] if multiple else result["nodes"][0]
+
+    def median(self) -> float | None:
+        return statistics.median(self.durations) if self.durations else None
@@ -1,12 +1,17 @@
 import json
 import logging
 import os
+import random
 import signal
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from const import *
 from data_fetcher import DataFetcher
+from metrics import METRICS
+from scheduler import Scheduler, parse_job_times
 
 
 def main():
@@ -23,6 +28,7 @@ def main():
         try:
             PHONE_NUMBER = options.get("PHONE_NUMBER")
             PASSWORD = options.get("PASSWORD")
+            JOB_START_TIME = options.get("JOB_START_TIME", "07:00")
             LOG_LEVEL = options.get("LOG_LEVEL", "INFO")
             RETRY_TIMES_LIMIT = int(options.get("RETRY_TIMES_LIMIT", 5))
 
@@ -47,6 +53,45 @@ def main():
                 options.get("RECHARGE_NOTIFY", "false")
             ).lower()
             os.environ["BALANCE"] = str(options.get("BALANCE", 5.0))
+            ACCOUNTS = options.get("ACCOUNTS") or []
+            MAX_WORKERS = int(options.get("MAX_WORKERS", 0) or 0)
+            os.environ["FETCH_MODE"] = str(options.get("FETCH_MODE", "selenium"))
+            os.environ["PAGE_MAJOR_TRAVERSAL"] = str(
+                options.get("PAGE_MAJOR_TRAVERSAL", "false")
+            ).lower()
+            os.environ["BULK_DOM_EXTRACT"] = str(
+                options.get("BULK_DOM_EXTRACT", "true")
+            ).lower()
+            os.environ["EVENT_DRIVEN_WAIT"] = str(
+                options.get("EVENT_DRIVEN_WAIT", "true")
+            ).lower()
+            os.environ["BLOCK_RESOURCES"] = str(
+                options.get("BLOCK_RESOURCES", "false")
+            ).lower()
+            if options.get("BLOCKED_URL_PATTERNS"):
+                os.environ["BLOCKED_URL_PATTERNS"] = options.get("BLOCKED_URL_PATTERNS")
+            os.environ["PERSISTENT_PROFILE"] = str(
+                options.get("PERSISTENT_PROFILE", "false")
+            ).lower()
+            os.environ["BROWSER_CACHE_SIZE_MB"] = str(
+                options.get("BROWSER_CACHE_SIZE_MB", 100)
+            )
+            os.environ["KEEP_BROWSER_ALIVE"] = str(
+                options.get("KEEP_BROWSER_ALIVE", "false")
+            ).lower()
+            os.environ["JOB_RANDOM_DELAY"] = str(options.get("JOB_RANDOM_DELAY", 600))
+            os.environ["JOB_INTERVAL_HOURS"] = str(
+                options.get("JOB_INTERVAL_HOURS", 12)
+            )
+            os.environ["ENABLE_CHECKPOINT"] = str(
+                options.get("ENABLE_CHECKPOINT", "true")
+            ).lower()
+            os.environ["ENABLE_SESSION_STORE"] = str(
+                options.get("ENABLE_SESSION_STORE", "true")
+            ).lower()
+            if options.get("METRICS_PORT"):
+                os.environ["METRICS_PORT"] = str(options.get("METRICS_PORT"))
+            os.environ["MQTT_DISCOVERY"] = options.get("MQTT_DISCOVERY", "sensor")
         except Exception as e:
             logging.error(
                 "Failing to read the options.json file, the program will exit with an error message: %s.",
@@ -60,6 +105,8 @@ def main():
             JOB_START_TIME = os.getenv("JOB_START_TIME", "07:00")
             LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
             RETRY_TIMES_LIMIT = int(os.getenv("RETRY_TIMES_LIMIT", "5"))
+            ACCOUNTS = load_accounts_file(os.getenv("ACCOUNTS_FILE"))
+            MAX_WORKERS = int(os.getenv("MAX_WORKERS", "0"))
 
             logger_init(LOG_LEVEL)
             logging.info("The current run runs as a docker image.")
@@ -69,23 +116,133 @@ def main():
                 e,
             )
             sys.exit()
-    run_task(DataFetcher(PHONE_NUMBER, PASSWORD))
-
-RUNNING = False
-def run_task(data_fetcher: DataFetcher):
-    global RUNNING
-    if RUNNING:
-        logging.info("has running task, break.")
-        return
-    RUNNING = True
+
+    if not ACCOUNTS:
+        ACCOUNTS = [{"PHONE_NUMBER": PHONE_NUMBER, "PASSWORD": PASSWORD}]
+    data_fetchers = [
+        DataFetcher(
+            account["PHONE_NUMBER"],
+            account["PASSWORD"],
+            ignore_user_id=account.get("IGNORE_USER_ID"),
+            # 同一个 client_id 的 MQTT 连接会互相踢下线
+            mqtt_client_id="sgcc" if len(ACCOUNTS) == 1 else f"sgcc_{index}",
+        )
+        for index, account in enumerate(ACCOUNTS)
+    ]
+    if os.getenv("METRICS_PORT"):
+        METRICS.serve(int(os.getenv("METRICS_PORT")))
+    max_workers = MAX_WORKERS or min(len(data_fetchers), os.cpu_count() or 1)
+    scheduler = Scheduler(
+        parse_job_times(JOB_START_TIME, int(os.getenv("JOB_INTERVAL_HOURS", 12))),
+        jitter_seconds=int(os.getenv("JOB_RANDOM_DELAY", 600)),
+    )
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        if os.getenv("RUN_ONCE", "false").lower() == "true":
+            scheduler.run_once(lambda: run_task(data_fetchers, max_workers))
+        else:
+            # 同一批 DataFetcher 在多次运行之间复用, 保留常驻浏览器等状态
+            scheduler.run_forever(
+                lambda: run_task(data_fetchers, max_workers),
+                stop,
+                # broker 恢复后尽快发布暂存的数据, 不用等下一次运行
+                idle_task=lambda: [
+                    data_fetcher.drain_spool() for data_fetcher in data_fetchers
+                ],
+                idle_interval=int(os.getenv("MQTT_SPOOL_RETRY_MINUTES", 5)) * 60,
+            )
+    finally:
+        for data_fetcher in data_fetchers:
+            data_fetcher.close()
+
+
+def load_accounts_file(path: str | None):
+    """
+    读取多账号配置文件, 格式为
+    [{"PHONE_NUMBER": "xxx", "PASSWORD": "xxx", "IGNORE_USER_ID": "xxx,xxx"}]
+    """
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        accounts = json.load(f)
+    for account in accounts:
+        if not account.get("PHONE_NUMBER") or not account.get("PASSWORD"):
+            raise ValueError(f"PHONE_NUMBER and PASSWORD are required in {path}")
+    return accounts
+
+
+def run_task(data_fetchers: list[DataFetcher], max_workers: int = 1) -> bool:
+    """run every account on a bounded pool of webdriver workers, True if all succeed"""
+    METRICS.start_run()
+    try:
+        return _run_accounts(data_fetchers, max_workers)
+    finally:
+        METRICS.write_run_summary()
+
+
+def _run_accounts(data_fetchers: list[DataFetcher], max_workers: int) -> bool:
+    if len(data_fetchers) == 1 or max_workers <= 1:
+        results = [fetch_with_retry(data_fetcher) for data_fetcher in data_fetchers]
+        return all(results)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="sgcc") as pool:
+        futures = {
+            pool.submit(fetch_with_retry, data_fetcher): data_fetcher
+            for data_fetcher in data_fetchers
+        }
+        results = {}
+        for future in as_completed(futures):
+            username = futures[future]._username
+            try:
+                results[username] = future.result()
+            except Exception as e:
+                logging.error("account %s failed: %s", username, e)
+                results[username] = False
+    logging.info(
+        "%d/%d accounts fetched successfully with %d workers in %.1fs.",
+        sum(results.values()),
+        len(results),
+        max_workers,
+        time.monotonic() - start,
+    )
+    return all(results.values())
+
+
+def fetch_with_retry(data_fetcher: DataFetcher) -> bool:
     for retry_times in range(1, RETRY_TIMES_LIMIT + 1):
         try:
             with data_fetcher:
-                data_fetcher.fetch()
-                RUNNING = False
-                return
-        except Exception:
-            logging.warning("run %d times failed, retry", retry_times)
+                with METRICS.timer("fetch"):
+                    data_fetcher.fetch()
+                METRICS.inc("sgcc_fetch_total", result="success")
+                return True
+        except Exception as e:
+            METRICS.inc("sgcc_fetch_total", result="failure")
+            if retry_times == RETRY_TIMES_LIMIT:
+                break
+            delay = retry_backoff(retry_times)
+            logging.warning(
+                "account %s run %d times failed (%s), retry in %.0fs",
+                data_fetcher._username,
+                retry_times,
+                e,
+                delay,
+            )
+            time.sleep(delay)
+    logging.error(
+        "account %s failed after %d tries.", data_fetcher._username, RETRY_TIMES_LIMIT
+    )
+    # 检查点只在本次运行的重试之间有效, 下次运行重新获取所有户号
+    data_fetcher.discard_checkpoint()
+    return False
+
+
+def retry_backoff(retry_times: int) -> float:
+    """exponential backoff with jitter, the unit is RETRY_WAIT_TIME_OFFSET_UNIT seconds"""
+    unit = int(os.getenv("RETRY_WAIT_TIME_OFFSET_UNIT", 10))
+    return min(unit * 2 ** (retry_times - 1), 600) * random.uniform(0.5, 1.5)
 
 
 def logger_init(level: str):
@@ -0,0 +1,184 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from const import *
+
+# 秒, 覆盖从几十毫秒的 DOM 读取到几分钟的整次运行
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PHASE_METRIC = "sgcc_phase_seconds"
+
+_HELP = {
+    PHASE_METRIC: "Duration of each fetch phase in seconds.",
+    "sgcc_mqtt_publish_total": "MQTT messages published.",
+    "sgcc_mqtt_skipped_total": "MQTT messages skipped because the payload didn't change.",
+    "sgcc_fetch_total": "Fetch runs per account by result.",
+    "sgcc_captcha_attempts_total": "Slider CAPTCHA attempts by result.",
+    "sgcc_captcha_logins_total": "Logins that passed the slider CAPTCHA.",
+}
+
+
+def _format_labels(labels: tuple, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class _Histogram:
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Phase histograms and event counters in the Prometheus text format, plus a
+    summary of the phases observed since start_run().
+    """
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms: typing.Dict[tuple, _Histogram] = {}
+        self._counters: typing.Dict[tuple, float] = {}
+        self._run: typing.Dict[str, typing.List[float]] = {}
+        self._run_counters: typing.Dict[str, float] = {}
+        self._run_started = time.time()
+
+    def observe(self, phase: str, seconds: float):
+        key = (PHASE_METRIC, (("phase", phase),))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = _Histogram(self._buckets)
+            self._histograms[key].observe(seconds)
+            self._run.setdefault(phase, []).append(seconds)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            run_key = name + _format_labels(key[1])
+            self._run_counters[run_key] = self._run_counters.get(run_key, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.monotonic() - start)
+
+    def start_run(self):
+        with self._lock:
+            self._run = {}
+            self._run_counters = {}
+            self._run_started = time.time()
+
+    def run_summary(self) -> dict:
+        with self._lock:
+            phases = {
+                phase: {
+                    "count": len(values),
+                    "total": round(sum(values), 3),
+                    "max": round(max(values), 3),
+                }
+                for phase, values in self._run.items()
+            }
+            return {
+                "started_at": self._run_started,
+                "duration": round(time.time() - self._run_started, 3),
+                "phases": phases,
+                "counters": dict(self._run_counters),
+            }
+
+    def write_run_summary(self, path: str = None) -> dict:
+        summary = self.run_summary()
+        path = path or os.path.join(DATA_PATH, "sgcc_run_summary.json")
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+        except OSError as e:
+            logging.warning("Fail to write run summary %s: %s", path, e)
+        slowest = sorted(
+            summary["phases"].items(), key=lambda item: item[1]["total"], reverse=True
+        )[:5]
+        logging.info(
+            "Run took %.1fs, slowest phases: %s",
+            summary["duration"],
+            ", ".join(f"{phase} {stats['total']:.1f}s" for phase, stats in slowest),
+        )
+        return summary
+
+    def render(self) -> str:
+        """the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            described = set()
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels, le=bound)} {cumulative}"
+                    )
+                lines.append(
+                    f'{name}_bucket{_format_labels(labels, le="+Inf")} {histogram.count}'
+                )
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """serve /metrics in a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logging.info("Serving metrics on http://%s:%d/metrics", host, port)
+        return server
+
+
+# 进程内共享, 各模块直接使用
+METRICS = Metrics()
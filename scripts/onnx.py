@@ -1,17 +1,147 @@
 # import cv2
+import logging
+import os
+import threading
+import time
+
 from PIL import ImageDraw,Image,ImageOps
 import numpy as np
 import onnxruntime
 
+from const import *
+from metrics import METRICS
+
 anchors = [[(116,90),(156,198),(373,326)],[(30,61),(62,45),(59,119)],[(10,13),(16,30),(33,23)]]
 anchors_yolo_tiny = [[(81, 82), (135, 169), (344, 319)], [(10, 14), (23, 27), (37, 58)]]
 CLASSES=["target"]
+# 模型输入尺寸
+INPUT_SIZE = 416
+
 
 
+_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+# 多个账号的 ONNX 实例共用同一个优化模型缓存文件
+_CACHE_LOCK = threading.Lock()
+
 
 class ONNX:
-    def __init__(self,onnx_file_name="captcha.onnx"):
-        self.onnx_session = onnxruntime.InferenceSession(onnx_file_name) 
+    def __init__(self,onnx_file_name="captcha.onnx", cache_dir=None):
+        self.onnx_file_name = onnx_file_name
+        # 优化后的模型缓存, 下次启动不用再优化
+        self._cache_dir = cache_dir if cache_dir is not None else DATA_PATH
+        self._session = None
+        self._lock = threading.Lock()
+        self.load_time = None
+        # 按比例缩放并填充, 不拉伸验证码图片
+        self.use_letterbox = os.getenv("ONNX_LETTERBOX", "false").lower() == "true"
+        # 覆盖 letterbox 模式的滑动距离补偿系数, 用 benchmark.py captcha --letterbox 的 best factor
+        compensation = os.getenv("ONNX_LETTERBOX_COMPENSATION")
+        self.letterbox_compensation = float(compensation) if compensation else None
+        # NMS 前最多保留的框数, 默认不限制; 候选框超过这个数时结果会少掉置信度低的框
+        top_k = os.getenv("ONNX_TOP_K")
+        self.top_k = int(top_k) if top_k else None
+        # 复用的 NCHW 输入, 每次识别不再重新分配; 只减少内存峰值, 耗时和原来差不多
+        self._input = np.empty((1, 3, INPUT_SIZE, INPUT_SIZE), dtype=np.float32)
+
+    @property
+    def onnx_session(self):
+        """created on first use, scan QR code login never needs the model"""
+        if self._session is None:
+            with self._lock, _CACHE_LOCK:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def slide_compensation(self, image):
+        """
+        Factor from the detected x to the slide distance. 1.06 was tuned on the
+        416x416 coordinates of the stretched input, letterbox returns original
+        image pixels, so its factor scales 1.06 by the image width.
+        """
+        if not self.use_letterbox:
+            return 1.06
+        if self.letterbox_compensation is not None:
+            return self.letterbox_compensation
+        width = image.shape[1] if isinstance(image, np.ndarray) else image.size[0]
+        return 1.06 * INPUT_SIZE / width
+
+    def _session_options(self):
+        options = onnxruntime.SessionOptions()
+        level = os.getenv("ONNX_GRAPH_OPTIMIZATION", "all").lower()
+        options.graph_optimization_level = _OPTIMIZATION_LEVELS.get(
+            level, onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        # 模型很小, 线程太多反而增加调度开销
+        options.intra_op_num_threads = int(
+            os.getenv("ONNX_INTRA_OP_THREADS", min(4, os.cpu_count() or 1))
+        )
+        options.inter_op_num_threads = int(os.getenv("ONNX_INTER_OP_THREADS", 1))
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        memory_arena = os.getenv("ONNX_MEMORY_ARENA", "true").lower() == "true"
+        options.enable_cpu_mem_arena = memory_arena
+        options.enable_mem_pattern = memory_arena
+        return options, level
+
+    def _cached_model_path(self, level):
+        if not self._cache_dir or level == "disable":
+            return None
+        name = os.path.splitext(os.path.basename(self.onnx_file_name))[0]
+        return os.path.join(
+            self._cache_dir, f"{name}.ort{onnxruntime.__version__}.{level}.onnx"
+        )
+
+    def _create_session(self):
+        start = time.monotonic()
+        options, level = self._session_options()
+        model_path = self.onnx_file_name
+        cached_path = self._cached_model_path(level)
+        cached = (
+            cached_path is not None
+            and os.path.isfile(cached_path)
+            and os.path.getmtime(cached_path) >= os.path.getmtime(model_path)
+        )
+        if cached:
+            # 已经优化过, 直接加载
+            model_path = cached_path
+            options.graph_optimization_level = (
+                onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            )
+        elif cached_path is not None:
+            # 先写到临时文件再替换, 其他进程不会读到写了一半的模型
+            tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+            options.optimized_model_filepath = tmp_path
+        try:
+            session = onnxruntime.InferenceSession(
+                model_path, options, providers=["CPUExecutionProvider"]
+            )
+        except Exception as e:
+            if not cached:
+                raise
+            logging.warning("Fail to load cached model %s, reload: %s", cached_path, e)
+            os.remove(cached_path)
+            return self._create_session()
+
+        if not cached and cached_path is not None:
+            try:
+                os.replace(tmp_path, cached_path)
+            except OSError as e:
+                logging.warning("Fail to cache optimized model %s: %s", cached_path, e)
+
+        self.load_time = time.monotonic() - start
+        METRICS.observe("onnx_session_load", self.load_time)
+        logging.info(
+            "ONNX session loaded in %.0f ms (optimization %s, %s, %d threads).",
+            self.load_time * 1000,
+            level,
+            "cached model" if cached else "optimized now",
+            options.intra_op_num_threads,
+        )
+        return session
 
     # sigmoid函数
     def sigmoid(self,x):
@@ -19,17 +149,6 @@ class ONNX:
         return s
 
 
-    # 获取预测正确的类别，以及概率和索引;
-    def get_result(self,class_scores):
-        class_score = 0
-        class_index = 0
-        for i in range(len(class_scores)):
-            if class_scores[i] > class_score:
-                class_index += 1
-                class_score = class_scores[i]
-        return class_score, class_index
-
-
     def xywh2xyxy(self,x):
         # [x, y, w, h] to [x1, y1, x2, y2]
         y = np.copy(x)
@@ -41,49 +160,34 @@ class ONNX:
 
     # dets:  array [x,6] 6个值分别为x1,y1,x2,y2,score,class
     # thresh: 阈值
-    def nms(self,dets, thresh):
-        # dets:x1 y1 x2 y2 score class
-        # x[:,n]就是取所有集合的第n个数据
-        x1 = dets[:, 0]
-        y1 = dets[:, 1]
-        x2 = dets[:, 2]
-        y2 = dets[:, 3]
-        # -------------------------------------------------------
-        #   计算框的面积
-        #	置信度从大到小排序
-        # -------------------------------------------------------
+    def nms(self, dets, thresh):
+        """
+        Greedy NMS over all classes in one pass, boxes of different classes are
+        shifted apart by class so they never overlap.
+        Return the indexes of the kept boxes in dets, by score from high to low.
+        """
+        # 置信度从大到小排序
+        order = dets[:, 4].argsort()[::-1]
+        boxes = dets[order, :4]
+        if dets.shape[1] > 5:
+            boxes = boxes + dets[order, 5:6] * (np.abs(boxes).max() + 1)
+        x1, y1, x2, y2 = boxes.T
         areas = (y2 - y1 + 1) * (x2 - x1 + 1)
-        scores = dets[:, 4]
-        # print(scores)
-        keep = []
-        index = scores.argsort()[::-1]  # np.argsort()对某维度从小到大排序
-        # [::-1] 从最后一个元素到第一个元素复制一遍。倒序从而从大到小排序
+        # 一次算出两两之间的 IOU
+        w = np.maximum(0, np.minimum(x2[:, None], x2) - np.maximum(x1[:, None], x1) + 1)
+        h = np.maximum(0, np.minimum(y2[:, None], y2) - np.maximum(y1[:, None], y1) + 1)
+        overlaps = w * h
+        ious = overlaps / (areas[:, None] + areas - overlaps)
 
-        while index.size > 0:
-            i = index[0]
+        suppressed = np.zeros(len(order), dtype=bool)
+        keep = []
+        for i in range(len(order)):
+            if suppressed[i]:
+                continue
             keep.append(i)
-            # -------------------------------------------------------
-            #   计算相交面积
-            #	1.相交
-            #	2.不相交
-            # -------------------------------------------------------
-            x11 = np.maximum(x1[i], x1[index[1:]])
-            y11 = np.maximum(y1[i], y1[index[1:]])
-            x22 = np.minimum(x2[i], x2[index[1:]])
-            y22 = np.minimum(y2[i], y2[index[1:]])
-
-            w = np.maximum(0, x22 - x11 + 1)
-            h = np.maximum(0, y22 - y11 + 1)
-
-            overlaps = w * h
-            # -------------------------------------------------------
-            #   计算该框与其它框的IOU，去除掉重复的框，即IOU值大的框
-            #	IOU小于thresh的框保留下来
-            # -------------------------------------------------------
-            ious = overlaps / (areas[i] + areas[index[1:]] - overlaps)
-            idx = np.where(ious <= thresh)[0]
-            index = index[idx + 1]
-        return keep
+            # IOU 大于 thresh 的框是重复的框
+            suppressed |= ious[i] > thresh
+        return order[keep]
 
 
     def draw(self,image, box_data):
@@ -112,59 +216,34 @@ class ONNX:
         return image
 
     # 获取预测框
-    def get_boxes(self, prediction, confidence_threshold=0.7, nms_threshold=0.6):
-        # 过滤掉无用的框
-        # -------------------------------------------------------
-        #   删除为1的维度
-        #	删除置信度小于conf_thres的BOX
-        # -------------------------------------------------------
-        # for i in range(len(prediction)):
-        feature_map = np.squeeze(prediction)# 删除数组形状中单维度条目(shape中为1的维度)
-        # […,4]：代表了取最里边一层的所有第4号元素，…代表了对:,:,:,等所有的的省略。此处生成：25200个第四号元素组成的数组
-        conf = feature_map[..., 4] > confidence_threshold  # 0 1 2 3 4 4是置信度，只要置信度 > conf_thres 的
-        box = feature_map[conf == True]  # 根据objectness score生成(n, 5+class_nm)，只留下符合要求的框
-
-        # -------------------------------------------------------
-        #   通过argmax获取置信度最大的类别
-        # -------------------------------------------------------
-        cls_cinf = box[..., 5:]  # 左闭右开（5 6 7 8），就只剩下了每个grid cell中各类别的概率
-        cls = []
-        for i in range(len(cls_cinf)):
-            cls.append(int(np.argmax(cls_cinf[i])))  # 剩下的objecctness score比较大的grid cell，分别对应的预测类别列表
-        all_cls = list(set(cls))  # 去重，找出图中都有哪些类别
-        # set() 函数创建一个无序不重复元素集，可进行关系测试，删除重复数据，还可以计算交集、差集、并集等。
-        # -------------------------------------------------------
-        #   分别对每个类别进行过滤
-        #   1.将第6列元素替换为类别下标
-        #	2.xywh2xyxy 坐标转换
-        #	3.经过非极大抑制后输出的BOX下标
-        #	4.利用下标取出非极大抑制后的BOX
-        # -------------------------------------------------------
-        output = []
-        for i in range(len(all_cls)):
-            curr_cls = all_cls[i]
-            curr_cls_box = []
-            curr_out_box = []
-
-            for j in range(len(cls)):
-                if cls[j] == curr_cls:
-                    box[j][5] = curr_cls
-                    curr_cls_box.append(box[j][:6])  # 左闭右开，0 1 2 3 4 5
-
-            curr_cls_box = np.array(curr_cls_box)  # 0 1 2 3 4 5 分别是 x y w h score class
-            curr_cls_box = self.xywh2xyxy(curr_cls_box)  # 0 1 2 3 4 5 分别是 x1 y1 x2 y2 score class
-            curr_out_box = self.nms(curr_cls_box, nms_threshold)  # 获得nms后，剩下的类别在curr_cls_box中的下标
-
-            for k in curr_out_box:
-                output.append(curr_cls_box[k])
-        output = np.array(output)
-        return output
+    def get_boxes(self, prediction, confidence_threshold=0.7, nms_threshold=0.6, top_k=None):
+        """
+        :param prediction: the model output, [1, n, 5 + classes] of x y w h objectness class scores.
+        :param top_k: keep at most top_k boxes by objectness before NMS, None keeps all.
+            With more candidates only the boxes of the top_k highest scores are returned.
+        :return: [m, 6] of x1 y1 x2 y2 score class, by score from high to low.
+        """
+        feature_map = np.squeeze(prediction)
+        feature_map = feature_map.reshape(-1, feature_map.shape[-1])
+        # 只留下置信度 > confidence_threshold 的框
+        box = feature_map[feature_map[:, 4] > confidence_threshold]
+        if len(box) == 0:
+            return np.zeros((0, 6), dtype=np.float32)
+        if top_k is not None and len(box) > top_k:
+            # 阈值很低时框很多, 限制 NMS 的计算量
+            box = box[np.argpartition(-box[:, 4], top_k)[:top_k]]
+
+        dets = np.empty((len(box), 6), dtype=np.float32)
+        dets[:, :4] = self.xywh2xyxy(box[:, :4])
+        dets[:, 4] = box[:, 4]
+        dets[:, 5] = box[:, 5:].argmax(axis=1)
+        return dets[self.nms(dets, nms_threshold)]
 
     def letterbox(self, img, new_shape=(640, 640), color=(114, 114, 114), auto=False, scaleFill=False, scaleup=True,
                     stride=32):
         '''图片归一化'''
         # Resize and pad image while meeting stride-multiple constraints
-        shape = img.shape[:2]  # current shape [height, width]
+        shape = img.size[::-1]  # current shape [height, width]
         if isinstance(new_shape, int):
             new_shape = (new_shape, new_shape)
 
@@ -196,26 +275,80 @@ class ONNX:
         left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
 
         # img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
-        img = ImageOps.expand(img, border=(left, top, right, bottom), fill=0)##left,top,right,bottom
+        img = ImageOps.expand(img, border=(left, top, right, bottom), fill=color)##left,top,right,bottom
         return img, ratio, (dw, dh)
 
+    def _preprocess(self, image):
+        """
+        Fill the reused [1, 3, 416, 416] float32 input from a PIL image.
+        :return: the input, the resized image, the (w, h) ratio and (dw, dh) padding.
+        """
+        if self.use_letterbox:
+            org_img, ratio, pad = self.letterbox(
+                image.convert("RGB"),
+                new_shape=(INPUT_SIZE, INPUT_SIZE),
+                color=(114, 114, 114),
+            )
+        else:
+            org_img = image.resize((INPUT_SIZE, INPUT_SIZE)).convert("RGB")
+            ratio = INPUT_SIZE / image.width, INPUT_SIZE / image.height
+            pad = 0.0, 0.0
+        # HWC uint8 转成 CHW float32 并归一化, 一次写入输入缓冲区
+        np.multiply(
+            np.asarray(org_img).transpose(2, 0, 1),
+            np.float32(1 / 255.0),
+            out=self._input[0],
+            dtype=np.float32,
+        )
+        return self._input, org_img, ratio, pad
+
+    def scale_boxes(self, boxes, ratio, pad, shape):
+        """map x1 y1 x2 y2 of the letterboxed input back to the original (w, h) image"""
+        boxes = boxes.copy()
+        boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - pad[0]) / ratio[0]).clip(0, shape[0])
+        boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - pad[1]) / ratio[1]).clip(0, shape[1])
+        return boxes
+
     def _inference(self,image):
-        # org_img = cv2.resize(image, [416, 416]) # resize后的原图 (640, 640, 3)
-        org_img = image.resize((416,416))
-        # img = cv2.cvtColor(org_img, cv2.COLOR_BGR2RGB).transpose(2, 0, 1)
-        img = org_img.convert("RGB")
-        img = np.array(img).transpose(2, 0, 1)
-        img = img.astype(dtype=np.float32)  # onnx模型的类型是type: float32[ , , , ]
-        img /= 255.0
-        img = np.expand_dims(img, axis=0) # [3, 640, 640]扩展为[1, 3, 640, 640]
-
-        inputs = {self.onnx_session.get_inputs()[0].name: img} 
-        prediction = self.onnx_session.run(None, inputs)[0] 
-        return prediction, org_img
+        img, org_img, ratio, pad = self._preprocess(image)
+        inputs = {self.onnx_session.get_inputs()[0].name: img}
+        prediction = self.onnx_session.run(None, inputs)[0]
+        return prediction, org_img, ratio, pad
+
+    def _detect(self, image):
+        """boxes of x1 y1 x2 y2 score class by score, and the resized image"""
+        if isinstance(image, np.ndarray):
+            # 直接读取的 canvas 像素, [h, w, 3或4]
+            image = Image.fromarray(np.ascontiguousarray(image[..., :3]))
+        self.onnx_session  # 首次使用时加载, 不计入推理时间
+        start = time.monotonic()
+        prediction, org_img, ratio, pad = self._inference(image)
+        METRICS.observe("onnx_inference", time.monotonic() - start)
+        logging.debug("ONNX inference took %.1f ms.", (time.monotonic() - start) * 1000)
+        with METRICS.timer("onnx_get_boxes"):
+            boxes = self.get_boxes(prediction=prediction, top_k=self.top_k)
+        if self.use_letterbox and len(boxes):
+            # 返回原图上的坐标; 拉伸模式沿用 416 宽度上的坐标, 和滑动补偿系数对应
+            boxes[:, :4] = self.scale_boxes(boxes[:, :4], ratio, pad, image.size)
+        return boxes, org_img
+
+    def get_candidates(self, image, max_candidates=3, min_gap=3):
+        """
+        Gap x offsets ranked by confidence, [(x, confidence)]. Boxes closer
+        than min_gap pixels to a better one are dropped.
+        """
+        boxes, _ = self._detect(image)
+        candidates = []
+        for box in boxes:
+            x = int(box[0])
+            if all(abs(x - other) >= min_gap for other, _ in candidates):
+                candidates.append((x, float(box[4])))
+            if len(candidates) >= max_candidates:
+                break
+        return candidates
 
     def get_distance(self,image,draw=False):
-        prediction, org_img = self._inference(image)
-        boxes = self.get_boxes(prediction=prediction)
+        boxes, org_img = self._detect(image)
         if len(boxes) == 0:
             print('No gaps were detected.')
             return 0
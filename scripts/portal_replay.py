@@ -0,0 +1,255 @@
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from selenium.common import exceptions as sel_ex
+from selenium.webdriver.remote.webdriver import WebDriver
+
+# 复制渲染后的 DOM: 去掉脚本, 内联样式表, canvas 换成同 id/class 的图片
+_SNAPSHOT_SCRIPT = """
+const css = Array.from(document.styleSheets).map((sheet) => {
+    try {
+        return Array.from(sheet.cssRules).map((rule) => rule.cssText).join("\\n");
+    } catch (e) {
+        return "";
+    }
+}).join("\\n");
+const canvases = Array.from(document.querySelectorAll("canvas"));
+const root = document.documentElement.cloneNode(true);
+Array.from(root.querySelectorAll("canvas")).forEach((canvas, i) => {
+    const img = document.createElement("img");
+    for (const attr of canvas.attributes) {
+        img.setAttribute(attr.name, attr.value);
+    }
+    img.setAttribute("data-replay-canvas", "");
+    try {
+        img.src = canvases[i].toDataURL("image/png");
+    } catch (e) {
+        // 跨域图片画过的 canvas 不能导出
+    }
+    img.width = canvases[i].width;
+    img.height = canvases[i].height;
+    canvas.replaceWith(img);
+});
+root.querySelectorAll("script, link[rel='stylesheet'], style").forEach((node) => node.remove());
+const style = document.createElement("style");
+style.textContent = css;
+root.querySelector("head").appendChild(style);
+return "<!DOCTYPE html>\\n" + root.outerHTML;
+"""
+
+# 回放页面里代替网页脚本: 还原 canvas, 切换标签页和下拉菜单, 按选择的户号换成该户号录制的页面,
+# 模拟登录: 拖动滑块松开后跳转到 my95598
+_REPLAY_SHIM = """
+<script>
+(() => {
+    const POPPERS = ".el-select-dropdown, .el-dropdown-menu";
+    const show = (node, visible) => { node.style.display = visible ? "" : "none"; };
+    const activateTab = (item) => {
+        const nav = item.closest(".el-tabs__nav");
+        nav.querySelectorAll(".el-tabs__item").forEach((other) => {
+            other.classList.toggle("is-active", other === item);
+            const pane = document.getElementById("pane-" + other.id.slice("tab-".length));
+            if (pane) {
+                show(pane, other === item);
+            }
+        });
+    };
+    const restore = () => {
+        document.querySelectorAll("img[data-replay-canvas]").forEach((img) => {
+            const canvas = document.createElement("canvas");
+            for (const attr of img.attributes) {
+                if (attr.name !== "src" && attr.name !== "data-replay-canvas") {
+                    canvas.setAttribute(attr.name, attr.value);
+                }
+            }
+            canvas.width = img.width;
+            canvas.height = img.height;
+            const draw = () => canvas.getContext("2d").drawImage(img, 0, 0);
+            img.complete ? draw() : img.addEventListener("load", draw);
+            img.replaceWith(canvas);
+        });
+        // 和刚打开网页一样: 第一个标签页, 下拉菜单收起
+        document.querySelectorAll(".el-tabs__nav").forEach((nav) => {
+            const first = nav.querySelector(".el-tabs__item");
+            if (first) {
+                activateTab(first);
+            }
+        });
+        document.querySelectorAll(POPPERS).forEach((popper) => show(popper, false));
+    };
+    restore();
+
+    let dragging = false;
+    document.addEventListener("mousedown", (e) => {
+        dragging = !!e.target.closest(".slide-verify-slider-mask-item");
+    });
+    document.addEventListener("mouseup", () => {
+        if (dragging) {
+            setTimeout(() => { location.href = "/osgweb/my95598"; }, 200);
+        }
+    });
+    document.addEventListener("click", (e) => {
+        const tab = e.target.closest(".el-tabs__item");
+        if (tab) {
+            activateTab(tab);
+            return;
+        }
+        if (e.target.closest(".el-input__suffix")) {
+            document.querySelectorAll(".el-select-dropdown").forEach((popper) => show(popper, true));
+            return;
+        }
+        if (e.target.closest(".el-dropdown")) {
+            document.querySelectorAll(".el-dropdown-menu").forEach((popper) => show(popper, true));
+            return;
+        }
+        const item = e.target.closest(".el-select-dropdown__item");
+        if (item) {
+            const index = Array.from(item.parentNode.children).indexOf(item);
+            const body = (window.REPLAY_USERS || {})[index];
+            if (body !== undefined) {
+                document.body.innerHTML = body;
+                restore();
+            } else {
+                document.querySelectorAll(POPPERS).forEach((popper) => show(popper, false));
+            }
+        }
+    });
+})();
+</script>
+"""
+
+_PAGE_FILE = re.compile(r"^(?P<name>[^.]+)(?:\.(?P<user>\d+))?\.html$")
+_BODY = re.compile(r"<body[^>]*>(.*)</body>", re.S | re.I)
+
+
+class PortalRecorder:
+    """
+    Save the rendered 95598 pages while a real fetch runs, so they can be
+    served by ReplayServer. The snapshots contain the account's user ids and
+    usage data, don't share them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def snapshot(self, driver: WebDriver, name: str = None):
+        """
+        save the current page as <name>.html, name defaults to the last url
+        segment, pages of one user id are named <page>.<user id index>
+        """
+        name = name or driver.current_url.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        try:
+            html = driver.execute_script(_SNAPSHOT_SCRIPT)
+        except sel_ex.WebDriverException as e:
+            logging.warning("Fail to snapshot page %s: %s", name, e)
+            return
+        with open(os.path.join(self.path, f"{name}.html"), "w", encoding="utf-8") as f:
+            f.write(html)
+        logging.info("Recorded page %s to %s.", name, self.path)
+
+
+class ReplayServer:
+    """
+    Serve recorded pages at the same paths as www.95598.cn. A page recorded
+    for several user ids is served as the first one, choosing another user id
+    in the page switches to its recording.
+    """
+
+    def __init__(self, path: str, port: int = 0, host: str = "127.0.0.1"):
+        self.path = path
+        recorded = {}
+        for file_name in os.listdir(path):
+            match = _PAGE_FILE.match(file_name)
+            if not match:
+                continue
+            with open(os.path.join(path, file_name), encoding="utf-8") as f:
+                user = match.group("user")
+                recorded.setdefault(match.group("name"), {})[
+                    -1 if user is None else int(user)
+                ] = f.read()
+        pages = self._pages = {
+            name: self._compose(variants) for name, variants in recorded.items()
+        }
+        if "login" not in pages:
+            raise ValueError(f"no login.html recorded in {path}")
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+                if name not in pages:
+                    self.send_error(404)
+                    return
+                body = pages[name].encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("replay: " + format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self.url = "http://%s:%d" % self._server.server_address[:2]
+
+    @staticmethod
+    def _compose(variants: typing.Dict[int, str]) -> str:
+        """the first recording with the bodies of every user id and the shim"""
+        html = variants[min(variants)]
+        bodies = {}
+        for user, variant in variants.items():
+            body = _BODY.search(variant)
+            if user >= 0 and body:
+                bodies[user] = body.group(1)
+        # 不能让 </script> 提前结束脚本
+        users = json.dumps(bodies, ensure_ascii=False).replace("</", "<\\/")
+        return html.replace(
+            "</body>",
+            f"<script>window.REPLAY_USERS = {users};</script>" + _REPLAY_SHIM + "</body>",
+        )
+
+    def start(self) -> "ReplayServer":
+        threading.Thread(
+            target=self._server.serve_forever, name="replay", daemon=True
+        ).start()
+        logging.info("Replaying %s on %s.", ", ".join(sorted(self._pages)), self.url)
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main(argv: typing.List[str] = None):
+    parser = argparse.ArgumentParser(
+        description="Serve recorded 95598 pages, record them by running with SGCC_RECORD_DIR set."
+    )
+    parser.add_argument("path", help="directory of recorded pages")
+    parser.add_argument("--port", type=int, default=8598)
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = ReplayServer(args.path, args.port, args.host)
+    print(f"SGCC_PORTAL_URL={server.url}")
+    try:
+        server.start()
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
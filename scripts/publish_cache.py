@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from const import *
+
+
+class PublishCache:
+    """
+    Hash of the last retained payload the broker acknowledged on each topic,
+    so a run only publishes what changed since the last one. Only retained
+    messages are cached, the broker keeps them for clients that subscribe later. Discovery configs are
+    payloads too, they're resent when the template in const.py or the device
+    info changes. Every resync_hours everything is sent again, in case the
+    broker or Home Assistant restarted and lost it.
+    """
+
+    def __init__(self, client_id: str, resync_hours: float = 24, path: str = None):
+        name = re.sub(r"[^0-9A-Za-z_-]", "_", client_id)
+        self._path = path or os.path.join(DATA_PATH, f"sgcc_mqtt_cache_{name}.json")
+        self._resync = resync_hours * 3600
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.skipped = 0
+        self._data = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if time.time() - data.get("resynced_at", 0) > self._resync:
+            logging.info("MQTT full resync, publish every topic.")
+            return {"resynced_at": time.time(), "topics": {}}
+        return data
+
+    @staticmethod
+    def digest(payload, retain: bool) -> str:
+        if not isinstance(payload, bytes):
+            payload = str(payload).encode("utf-8")
+        return hashlib.sha1(b"%d:%s" % (retain, payload)).hexdigest()
+
+    def changed(self, topic: str, digest: str) -> bool:
+        with self._lock:
+            if self._data["topics"].get(topic) == digest:
+                self.skipped += 1
+                return False
+            self.sent += 1
+            return True
+
+    def acknowledged(self, topic: str, digest: str):
+        with self._lock:
+            self._data["topics"][topic] = digest
+
+    def save(self):
+        with self._lock:
+            try:
+                with open(self._path, "w", encoding="utf-8") as f:
+                    json.dump(self._data, f)
+            except OSError as e:
+                logging.warning("Fail to save MQTT publish cache: %s", e)
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import threading
+import typing
+
+from selenium.common import exceptions as sel_ex
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from const import *
+
+# 统计和广告脚本, 视频等读取数据不需要的资源
+DEFAULT_BLOCKED_PATTERNS = [
+    "*hm.baidu.com*",
+    "*cnzz.com*",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*.mp4",
+    "*.webm",
+]
+# 图片只在登录后屏蔽, 登录页的滑块验证码需要加载图片
+IMAGE_PATTERNS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico"]
+
+_PAGE_METRICS_SCRIPT = """
+const nav = performance.getEntriesByType("navigation")[0];
+const resources = performance.getEntriesByType("resource");
+const paint = performance.getEntriesByName("first-contentful-paint")[0]
+    || performance.getEntriesByName("first-paint")[0];
+return {
+    bytes: resources.reduce((sum, r) => sum + (r.transferSize || 0), nav ? nav.transferSize : 0),
+    requests: resources.length + 1,
+    load_time: nav ? nav.loadEventEnd - nav.startTime : null,
+    first_paint: paint ? paint.startTime : null,
+};
+"""
+
+
+class ResourceFilter:
+    """Block unneeded requests with CDP Network.setBlockedURLs."""
+
+    def __init__(self, driver: WebDriver, patterns: typing.List[str] = None):
+        self._driver = driver
+        self._patterns = patterns or DEFAULT_BLOCKED_PATTERNS
+        # 远程 selenium 没有 CDP 接口
+        self.enabled = hasattr(driver, "execute_cdp_cmd")
+        if not self.enabled:
+            logging.warning("Webdriver doesn't support CDP, resource filter disabled.")
+
+    def apply(self, block_images: bool = False):
+        if not self.enabled:
+            return
+        patterns = self._patterns + (IMAGE_PATTERNS if block_images else [])
+        try:
+            self._driver.execute_cdp_cmd("Network.enable", {})
+            self._driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+            logging.debug("Blocked url patterns: %s", patterns)
+        except sel_ex.WebDriverException as e:
+            logging.warning("Fail to set blocked urls: %s", e)
+
+
+def page_load_metrics(driver: WebDriver) -> dict | None:
+    """transferred bytes, load time and first paint of the current page from the Performance API"""
+    try:
+        return driver.execute_script(_PAGE_METRICS_SCRIPT)
+    except sel_ex.WebDriverException as e:
+        logging.debug("Fail to read page load metrics: %s", e)
+        return None
+
+
+class PageLoadStats:
+    """
+    Average page size and load time per page, kept apart for runs with and
+    without the resource filter so the two can be compared across runs.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path: str = None):
+        self._path = path or os.path.join(DATA_PATH, "page_load_stats.json")
+
+    def record(self, url: str, filtered: bool, metrics: dict | None):
+        if not metrics or metrics.get("load_time") is None:
+            return
+        mode = "filtered" if filtered else "unfiltered"
+        page = url.rstrip("/").rsplit("/", 1)[-1]
+        with self._lock:
+            stats = self._load()
+            entry = stats.setdefault(page, {}).setdefault(
+                mode, {"count": 0, "bytes": 0, "load_time": 0.0}
+            )
+            entry["count"] += 1
+            entry["bytes"] += metrics["bytes"]
+            entry["load_time"] += metrics["load_time"]
+            try:
+                with open(self._path, "w", encoding="utf-8") as f:
+                    json.dump(stats, f)
+            except OSError as e:
+                logging.debug("Fail to write page load stats: %s", e)
+
+        logging.info(
+            "Page %s loaded %.0f KB in %.0f ms (%s).",
+            page,
+            metrics["bytes"] / 1024,
+            metrics["load_time"],
+            mode,
+        )
+        other = stats[page].get("unfiltered" if filtered else "filtered")
+        if other:
+            logging.info(
+                "Page %s average: filtered %s, unfiltered %s.",
+                page,
+                self._average(stats[page].get("filtered")),
+                self._average(stats[page].get("unfiltered")),
+            )
+
+    @staticmethod
+    def _average(entry):
+        return "%.0f KB / %.0f ms" % (
+            entry["bytes"] / entry["count"] / 1024,
+            entry["load_time"] / entry["count"],
+        )
+
+    def _load(self) -> dict:
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import random
+import threading
+import typing
+from datetime import datetime, timedelta
+
+from const import *
+
+
+def parse_job_times(job_start_time: str, interval_hours: int = 12):
+    """
+    "07:00" -> 07:00 and every interval_hours after it within a day,
+    interval_hours must divide 24,
+    "07:00,19:30" -> exactly the listed times.
+    """
+    times = []
+    for item in job_start_time.split(","):
+        hour, minute = item.strip().split(":")
+        times.append((int(hour), int(minute)))
+    if interval_hours <= 0 or 24 % interval_hours:
+        # 不能整除时跨过零点的间隔会和其他间隔不一样
+        raise ValueError(f"JOB_INTERVAL_HOURS {interval_hours} doesn't divide 24")
+    if len(times) == 1 and interval_hours < 24:
+        hour, minute = times[0]
+        times = [((hour + i * interval_hours) % 24, minute) for i in range(24 // interval_hours)]
+    for hour, minute in times:
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(f"invalid JOB_START_TIME {job_start_time}")
+    return sorted(set(times))
+
+
+class Scheduler:
+    """
+    Run a task at fixed times of the day with random jitter, one run at a time.
+    A run missed while the process was down is caught up once at startup.
+    """
+
+    def __init__(
+        self,
+        times: typing.List[typing.Tuple[int, int]],
+        jitter_seconds: int = 0,
+        state_path: str = None,
+    ):
+        self._times = times
+        self._jitter = jitter_seconds
+        self._state_path = state_path or os.path.join(DATA_PATH, "sgcc_schedule.json")
+        self._lock = threading.Lock()
+
+    def _slots(self, day: datetime):
+        return [
+            day.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            for hour, minute in self._times
+        ]
+
+    def next_slot(self, now: datetime) -> datetime:
+        for day in (now, now + timedelta(days=1)):
+            for slot in self._slots(day):
+                if slot > now:
+                    return slot
+        raise AssertionError("no schedule time")
+
+    def previous_slot(self, now: datetime) -> datetime:
+        for day in (now, now - timedelta(days=1)):
+            for slot in reversed(self._slots(day)):
+                if slot <= now:
+                    return slot
+        raise AssertionError("no schedule time")
+
+    def _last_run(self) -> datetime | None:
+        try:
+            with open(self._state_path, encoding="utf-8") as f:
+                return datetime.fromisoformat(json.load(f)["last_run"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_last_run(self, when: datetime):
+        try:
+            with open(self._state_path, "w", encoding="utf-8") as f:
+                json.dump({"last_run": when.isoformat()}, f)
+        except OSError as e:
+            logging.warning("Fail to save schedule state: %s", e)
+
+    def missed_run(self, now: datetime) -> bool:
+        last_run = self._last_run()
+        return last_run is None or last_run < self.previous_slot(now)
+
+    def run_once(self, task: typing.Callable[[], typing.Any]) -> bool:
+        """
+        run the task unless a previous run is still going, a task that raises
+        or returns False failed and is caught up after a restart
+        """
+        if not self._lock.acquire(blocking=False):
+            logging.info("has running task, break.")
+            return False
+        try:
+            started = datetime.now()
+            if task() is False:
+                logging.error("Scheduled task failed.")
+                return False
+            # 失败的运行不记录, 重启后会补跑
+            self._save_last_run(started)
+            return True
+        except Exception as e:
+            logging.error("Scheduled task failed: %s", e)
+            return False
+        finally:
+            self._lock.release()
+
+    def _run_idle(self, idle_task: typing.Callable[[], typing.Any]):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            idle_task()
+        except Exception as e:
+            logging.error("Idle task failed: %s", e)
+        finally:
+            self._lock.release()
+
+    def run_forever(
+        self,
+        task: typing.Callable[[], typing.Any],
+        stop: threading.Event,
+        idle_task: typing.Callable[[], typing.Any] = None,
+        idle_interval: float = 300,
+    ):
+        """run the task at the scheduled times and idle_task every idle_interval seconds"""
+        if self.missed_run(datetime.now()):
+            logging.info("No run since the last scheduled time, run now.")
+            self.run_once(task)
+        while not stop.is_set():
+            next_run = self.next_slot(datetime.now())
+            # 随机延迟, 避免所有人同一秒请求国网
+            next_run += timedelta(seconds=random.uniform(0, self._jitter))
+            logging.info("Next run at %s.", next_run.strftime("%Y-%m-%d %H:%M:%S"))
+            while True:
+                remaining = (next_run - datetime.now()).total_seconds()
+                if remaining <= 0:
+                    break
+                if stop.wait(min(remaining, idle_interval) if idle_task else remaining):
+                    return
+                if idle_task and datetime.now() < next_run:
+                    self._run_idle(idle_task)
+            self.run_once(task)
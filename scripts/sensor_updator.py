@@ -1,7 +1,10 @@
 import os
 import json
+import time
 import typing
 import logging
+import collections
+import re
 from datetime import datetime, timedelta
 
 import requests
@@ -9,6 +12,8 @@ from paho.mqtt.client import Client
 from paho.mqtt.enums import MQTTErrorCode
 
 from const import *
+from metrics import METRICS
+from publish_cache import PublishCache
 
 
 class SensorUpdator:
@@ -189,39 +194,197 @@ class SensorUpdator:
 
 
 class MQTTSensorUpdator:
-    def __init__(self, username: str, password: str, host: str, port: int):
-        self._client = Client(client_id="sgcc")
+    """
+    One MQTT connection for the whole run with the network loop in a thread.
+    Publishes are pipelined, at most max_inflight of them wait for the broker,
+    and the `with` block waits for all of them when it exits. QoS 0 has no
+    acknowledgement to wait for, its messages leave in order, so only the last
+    one is waited for. With a cache,
+    payloads the broker already has are skipped.
+    """
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        host: str,
+        port: int,
+        client_id="sgcc",
+        max_inflight: int = 20,
+        qos: int = 0,
+        timeout: float = 30,
+        cache: PublishCache | None = None,
+        discovery: str = "sensor",
+        series_resync_hours: float = 24,
+    ):
+        self._client = Client(client_id=client_id)
         self._host = host
         self._port = port
         self._client.username_pw_set(username, password)
-
-    def __enter__(self):
+        self._client.max_inflight_messages_set(max_inflight)
+        self._max_inflight = max_inflight
+        self._qos = qos
+        self._timeout = timeout
+        self._pending = collections.deque()
+        # QoS 0: 最后一条消息和等它发出后才记录到缓存的消息
+        self._last_info = None
+        self._unconfirmed = []
+        self._connected = False
+        self._cache = cache
+        # sensor: 每个传感器一条自动发现消息, device: 每个户号一条
+        self._discovery = discovery
+        # 每个户号上次使用的自动发现方式, 切换时清除另一种方式的配置, 只清除一次
+        name = re.sub(r"[^0-9A-Za-z_-]", "_", client_id)
+        self._discovery_path = os.path.join(
+            DATA_PATH, f"sgcc_mqtt_discovery_{name}.json"
+        )
+        self._discovery_modes = self._load_state(self._discovery_path)
+        self._discovery_pending = {}
+        # 每个序列 broker 已有的最后一天和上次完整发送的时间, 之后只发新增的天
+        self._series_path = os.path.join(DATA_PATH, f"sgcc_mqtt_series_{name}.json")
+        self._series = self._load_state(self._series_path)
+        self._series_pending = {}
+        self._series_resync = series_resync_hours * 3600
+
+    def connect(self):
+        if self._connected:
+            return
         if (
             self._client.connect(self._host, self._port)
             != MQTTErrorCode.MQTT_ERR_SUCCESS
         ):
             raise RuntimeError("Failed to connect to MQTT server.")
+        self._client.loop_start()
+        self._connected = True
+        deadline = time.monotonic() + self._timeout
+        while not self._client.is_connected():
+            if time.monotonic() > deadline:
+                self.close()
+                raise RuntimeError("MQTT server didn't accept the connection.")
+            time.sleep(0.002)
+
+    def close(self):
+        if not self._connected:
+            return
+        self._connected = False
+        self._pending.clear()
+        self._last_info = None
+        self._unconfirmed.clear()
+        self._discovery_pending.clear()
+        self._series_pending.clear()
+        self._client.disconnect()
+        self._client.loop_stop()
+        if self._cache:
+            self._cache.save()
+            logging.info(
+                "MQTT messages sent %d, skipped %d unchanged.",
+                self._cache.sent,
+                self._cache.skipped,
+            )
+
+    def __enter__(self):
+        self.connect()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._client.disconnect()
-
-    def ping(self):
+        if exc_type is None:
+            self.flush()
+
+    def flush(self):
+        """wait until the broker has every pending message"""
+        deadline = time.monotonic() + self._timeout
+        with METRICS.timer("mqtt_flush"):
+            while self._pending:
+                self._wait_oldest(max(0.0, deadline - time.monotonic()))
+            if self._last_info is not None:
+                self._wait_last(max(0.0, deadline - time.monotonic()))
+        if self._discovery_pending:
+            self._discovery_modes.update(self._discovery_pending)
+            self._discovery_pending.clear()
+            self._save_state(self._discovery_path, self._discovery_modes)
+        if self._series_pending:
+            self._series.update(self._series_pending)
+            self._series_pending.clear()
+            self._save_state(self._series_path, self._series)
+
+    @staticmethod
+    def _load_state(path: str) -> dict:
         try:
-            self._client.publish("test", "1").wait_for_publish()
-            return True
-        except:
-            return False
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
 
-    def _publish_message(self, topic: str, payload: str, retain: bool = False):
+    @staticmethod
+    def _save_state(path: str, state: dict):
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+        except OSError as e:
+            logging.warning("Fail to save MQTT state %s: %s", path, e)
+
+    def _wait_oldest(self, timeout: float):
+        info, topic, digest = self._pending.popleft()
+        info.wait_for_publish(timeout)
+        if not info.is_published():
+            self._pending.clear()
+            raise RuntimeError("MQTT publish wasn't acknowledged in time.")
+        if digest:
+            # 只记录 broker 确认收到的消息, 发送失败的下次会重发
+            self._cache.acknowledged(topic, digest)
+
+    def _wait_last(self, timeout: float):
+        info, self._last_info = self._last_info, None
+        info.wait_for_publish(timeout)
+        if not info.is_published():
+            self._unconfirmed.clear()
+            raise RuntimeError("MQTT publish wasn't sent in time.")
+        for topic, digest in self._unconfirmed:
+            self._cache.acknowledged(topic, digest)
+        self._unconfirmed.clear()
+
+    def _publish_message(
+        self,
+        topic: str,
+        payload: str | bytes,
+        retain: bool = False,
+        use_cache: bool = True,
+    ):
         """
         Publish a message to the MQTT broker.
 
         :param topic: The MQTT topic to publish to.
         :param payload: The message payload.
         :param retain: Whether to retain the message on the broker.
+        :param use_cache: Skip the message if the broker already has the same payload.
         """
-        self._client.publish(topic, payload, retain=retain).wait_for_publish()
+        digest = None
+        # 不保留的消息 broker 不会留给之后订阅的客户端, 不能因为没变就跳过
+        if self._cache and use_cache and retain:
+            digest = PublishCache.digest(payload, retain)
+            if not self._cache.changed(topic, digest):
+                METRICS.inc("sgcc_mqtt_skipped_total")
+                return
+        if self._qos == 0:
+            # 没有确认, 不需要窗口, 按顺序发出, flush 时等最后一条
+            with METRICS.timer("mqtt_publish"):
+                info = self._client.publish(topic, payload, qos=0, retain=retain)
+            if info.rc == MQTTErrorCode.MQTT_ERR_NO_CONN:
+                raise RuntimeError("MQTT connection lost.")
+            self._last_info = info
+            if digest:
+                self._unconfirmed.append((topic, digest))
+            METRICS.inc("sgcc_mqtt_publish_total")
+            return
+        if len(self._pending) >= self._max_inflight:
+            # 窗口已满, 等最早的一条发送完成
+            self._wait_oldest(self._timeout)
+        with METRICS.timer("mqtt_publish"):
+            info = self._client.publish(topic, payload, qos=self._qos, retain=retain)
+        if info.rc == MQTTErrorCode.MQTT_ERR_NO_CONN:
+            raise RuntimeError("MQTT connection lost.")
+        self._pending.append((info, topic, digest))
+        METRICS.inc("sgcc_mqtt_publish_total")
 
     def _publish_value(
         self,
@@ -238,16 +401,32 @@ class MQTTSensorUpdator:
         :param state: The state value to publish.
         :param attributes: Optional attributes to include in the message.
         """
-        _, _, state_topic, attr_topic = get_message(msg_enum, user_id)
-        # self._publish_message(config_topic, json.dumps(config), True)
-        self._publish_message(state_topic, state)
+        topics = topics_for(user_id).sensors[msg_enum]
+        # 保留消息, homeassistant 重启后不会因为数据没变被跳过而一直是 unknown
+        self._publish_message(topics.state_topic, state, True)
         if attributes:
-            self._publish_message(attr_topic, json.dumps(attributes))
+            self._publish_message(topics.attr_topic, json.dumps(attributes), True)
 
     def publish_config(self, user_id: str):
-        for _, config in MQTT_MsgEnum.__members__.items():
-            config_topic, config, _, _ = get_message(config, user_id)
-            self._publish_message(config_topic, json.dumps(config), True)
+        topics = topics_for(user_id)
+        previous = self._discovery_modes.get(user_id)
+        if previous != self._discovery:
+            # 切换方式后清除另一种配置, 否则相同 unique_id 的传感器会冲突
+            if previous is None:
+                # 旧版本所有户号共用的配置 topic
+                for msg_type in MQTT_MsgEnum:
+                    self._publish_message(msg_type.value[1], "", True)
+            if self._discovery == "device" and previous == "sensor":
+                for sensor in topics.sensors.values():
+                    self._publish_message(sensor.config_topic, "", True)
+            elif previous == "device":
+                self._publish_message(topics.device_topic, "", True)
+            self._discovery_pending[user_id] = self._discovery
+        if self._discovery == "device":
+            self._publish_message(topics.device_topic, topics.device_config, True)
+            return
+        for sensor in topics.sensors.values():
+            self._publish_message(sensor.config_topic, sensor.config, True)
 
     def update_one_userid(
         self,
@@ -299,10 +478,61 @@ class MQTTSensorUpdator:
 
         # Optionally publish last days' usages
         if lastdays_usages:
-            for day, usage in lastdays_usages:
-                self._publish_value(
-                    MQTT_MsgEnum.LASTDAILY_USAGE_MSG,
-                    user_id,
-                    usage,
-                    attributes={"date": day},
+            self._publish_history(user_id, lastdays_usages)
+
+    def _publish_history(
+        self, user_id: str, lastdays_usages: typing.List[typing.Tuple[str, float]]
+    ):
+        """
+        Publish the daily usages as one series, oldest day first. The full
+        series is sent the first time, every series_resync_hours and when days
+        are missing since the last run, otherwise only the new days are sent
+        to the append topic.
+
+        :param user_id: The user ID.
+        :param lastdays_usages: List of (day, usage) for the last days.
+        """
+        topics = topics_for(user_id).sensors[MQTT_MsgEnum.DAILY_HISTORY_MSG]
+        days = sorted(dict(lastdays_usages).items())
+        series = self._series.get(topics.attr_topic)
+        now = time.time()
+        if series is None or now - series["full_at"] >= self._series_resync:
+            new_days = None
+        else:
+            new_days = [item for item in days if item[0] > series["end"]]
+            if new_days and not self._follows(series["end"], new_days[0][0]):
+                new_days = None
+        if new_days is None:
+            self._publish_message(
+                topics.attr_topic, self._series_payload(days), True
+            )
+            full_at = now
+        else:
+            if new_days:
+                self._publish_message(
+                    DAILY_HISTORY_APPEND_TOPIC.format(user_id=user_id),
+                    self._series_payload(new_days),
                 )
+            full_at = series["full_at"]
+        self._publish_message(topics.state_topic, days[-1][1], True)
+        # flush 确认 broker 收到后才记录
+        self._series_pending[topics.attr_topic] = {
+            "end": max(days[-1][0], series["end"]) if series else days[-1][0],
+            "full_at": full_at,
+        }
+
+    @staticmethod
+    def _series_payload(days: typing.List[typing.Tuple[str, float]]) -> str:
+        return json.dumps(
+            {"dates": [day for day, _ in days], "values": [usage for _, usage in days]},
+            separators=(",", ":"),
+        )
+
+    @staticmethod
+    def _follows(last_day: str, day: str) -> bool:
+        """whether day is the day after last_day, a gap needs the full series"""
+        try:
+            last = datetime.strptime(last_day, "%Y-%m-%d")
+            return datetime.strptime(day, "%Y-%m-%d") - last == timedelta(days=1)
+        except ValueError:
+            return False
@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+from selenium.common import exceptions as sel_ex
+from selenium.webdriver.common.by import By
+from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.support.wait import WebDriverWait
+
+from const import *
+
+_DUMP_STORAGE_SCRIPT = """
+const dump = (storage) => {
+    const items = {};
+    for (let i = 0; i < storage.length; i++) {
+        const key = storage.key(i);
+        items[key] = storage.getItem(key);
+    }
+    return items;
+};
+return {local: dump(window.localStorage), session: dump(window.sessionStorage)};
+"""
+
+_LOAD_STORAGE_SCRIPT = """
+const [local, session] = arguments;
+for (const [key, value] of Object.entries(local || {})) {
+    window.localStorage.setItem(key, value);
+}
+for (const [key, value] of Object.entries(session || {})) {
+    window.sessionStorage.setItem(key, value);
+}
+"""
+
+
+def wait_logged_in(driver: WebDriver, timeout: float = 10) -> bool:
+    """
+    Wait for the loaded 95598 page to settle: True once the user menu of a
+    logged-in page renders, False when the portal redirects to the login page
+    or neither happens in time. The url alone proves nothing, the page only
+    redirects after its scripts found the session invalid.
+    """
+
+    def settled(d):
+        if d.current_url.split("?")[0].startswith(LOGIN_URL):
+            return "login"
+        if d.find_elements(By.CLASS_NAME, "el-dropdown"):
+            return "logged_in"
+        return False
+
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=0.2).until(settled) == "logged_in"
+    except sel_ex.TimeoutException:
+        return False
+
+
+class SessionStore:
+    """
+    Persist the authenticated 95598 session (cookies and web storage) on disk,
+    keyed by login account, so that later runs can skip the slider CAPTCHA.
+    """
+
+    _instances: typing.Dict[str, "SessionStore"] = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path: str = None) -> "SessionStore":
+        """one store per file, so that concurrent fetchers don't overwrite each other"""
+        path = path or os.path.join(DATA_PATH, "sgcc_session.json")
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def __init__(self, path: str = None):
+        self._path = path or os.path.join(DATA_PATH, "sgcc_session.json")
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.isfile(self._path):
+            return {"sessions": {}, "stats": {}}
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                data = json.load(f)
+            data.setdefault("sessions", {})
+            data.setdefault("stats", {})
+            return data
+        except (OSError, ValueError) as e:
+            logging.warning("Session store %s is unreadable, reset it: %s", self._path, e)
+            return {"sessions": {}, "stats": {}}
+
+    def _dump(self):
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path)
+
+    def save(self, key: str, driver: WebDriver):
+        """save cookies and web storage of the current logged-in page"""
+        now = time.time()
+        cookies = [
+            cookie
+            for cookie in driver.get_cookies()
+            if "95598" in cookie.get("domain", "") and cookie.get("expiry", now + 1) > now
+        ]
+        storage = driver.execute_script(_DUMP_STORAGE_SCRIPT)
+        with self._lock:
+            self._data["sessions"][key] = {
+                "cookies": cookies,
+                "local_storage": storage.get("local", {}),
+                "session_storage": storage.get("session", {}),
+                "saved_at": int(now),
+            }
+            try:
+                self._dump()
+            except OSError as e:
+                logging.warning("Fail to write session store %s: %s", self._path, e)
+                return
+        logging.info("Login session saved to session store, %d cookies.", len(cookies))
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if self._data["sessions"].pop(key, None) is not None:
+                try:
+                    self._dump()
+                except OSError as e:
+                    logging.warning("Fail to write session store %s: %s", self._path, e)
+
+    def restore(self, key: str, driver: WebDriver, timeout: int = 10) -> bool:
+        """
+        Restore the stored session into the driver and check that my95598
+        renders logged in instead of redirecting to login.
+
+        :return: True when the stored session is still valid.
+        """
+        with self._lock:
+            session = self._data["sessions"].get(key)
+        if not session:
+            logging.info("No stored login session for %s.", key)
+            self._record(key, hit=False)
+            return False
+
+        try:
+            # cookies can only be added for the domain currently loaded
+            driver.get(LOGIN_URL)
+            now = time.time()
+            for cookie in session["cookies"]:
+                if cookie.get("expiry", now + 1) <= now:
+                    continue
+                cookie = {k: v for k, v in cookie.items() if k != "sameSite"}
+                try:
+                    driver.add_cookie(cookie)
+                except sel_ex.WebDriverException as e:
+                    logging.debug("Skip cookie %s: %s", cookie.get("name"), e)
+            driver.execute_script(
+                _LOAD_STORAGE_SCRIPT,
+                session.get("local_storage", {}),
+                session.get("session_storage", {}),
+            )
+            driver.get(MY95598_URL)
+            if not wait_logged_in(driver, timeout):
+                logging.info("Stored login session for %s has expired.", key)
+                self.invalidate(key)
+                self._record(key, hit=False)
+                return False
+        except sel_ex.WebDriverException as e:
+            logging.warning("Fail to restore login session for %s: %s", key, e)
+            self._record(key, hit=False)
+            return False
+
+        self._record(key, hit=True)
+        return True
+
+    def _record(self, key: str, hit: bool):
+        with self._lock:
+            stats = self._data["stats"].setdefault(key, {"hit": 0, "miss": 0})
+            stats["hit" if hit else "miss"] += 1
+            try:
+                self._dump()
+            except OSError as e:
+                logging.warning("Fail to write session store %s: %s", self._path, e)
+        logging.info(
+            "Session store %s for %s, hit %d / miss %d, CAPTCHA avoided in %.0f%% of logins.",
+            "hit" if hit else "miss",
+            key,
+            stats["hit"],
+            stats["miss"],
+            100.0 * stats["hit"] / (stats["hit"] + stats["miss"]),
+        )
+
+    def stats(self, key: str) -> dict:
+        with self._lock:
+            return dict(self._data["stats"].get(key, {"hit": 0, "miss": 0}))
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import typing
+
+from const import *
+
+
+class UpdateSpool:
+    """
+    Sensor updates waiting for the MQTT broker, one JSON line per user id
+    appended as soon as its data is collected. Draining replays them in
+    order and removes the ones that were published, the rest stay for the
+    next run, so a broker outage never costs another portal login.
+
+    Only the latest update of a user id matters, older ones are compacted
+    away when the file grows over max_bytes and before each drain.
+    """
+
+    def __init__(self, client_id: str, max_bytes: int = 1024 * 1024, path: str = None):
+        name = re.sub(r"[^0-9A-Za-z_-]", "_", client_id)
+        self._path = path or os.path.join(DATA_PATH, f"sgcc_spool_{name}.jsonl")
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _read(self) -> typing.List[dict]:
+        records = []
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # 写到一半被中断的行
+                        logging.warning("Skip a broken line in %s.", self._path)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _rewrite(self, records: typing.List[dict]):
+        if not records:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+            return
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+    @staticmethod
+    def _compact(records: typing.List[dict]) -> typing.List[dict]:
+        """the latest update of each user id, in the order they were written"""
+        latest = {record["user_id"]: index for index, record in enumerate(records)}
+        return [records[index] for index in sorted(latest.values())]
+
+    def append(self, user_id: str, data: typing.Sequence):
+        record = {"user_id": user_id, "at": time.time(), "data": list(data)}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self._path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.getsize(self._path) > self._max_bytes:
+                records = self._compact(self._read())
+                while (
+                    len(records) > 1
+                    and sum(
+                        len(json.dumps(r, ensure_ascii=False).encode("utf-8")) + 1
+                        for r in records
+                    )
+                    > self._max_bytes
+                ):
+                    dropped = records.pop(0)
+                    logging.warning(
+                        "MQTT spool is full, drop the update of %s from %s.",
+                        dropped["user_id"],
+                        time.ctime(dropped["at"]),
+                    )
+                self._rewrite(records)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._read())
+
+    def drain(self, publish: typing.Callable[[str, list], None]) -> int:
+        """
+        Replay the updates in order with publish(user_id, data), stop at the
+        first one that raises and keep it and the rest.
+
+        :return: The number of updates published.
+        """
+        with self._lock:
+            records = self._compact(self._read())
+            done = 0
+            try:
+                for record in records:
+                    publish(record["user_id"], record["data"])
+                    done += 1
+            finally:
+                self._rewrite(records[done:])
+            return done